@@ -1,10 +1,40 @@
-import pandas as pd
+from __future__ import annotations
 import mysql.connector as mysql
 import os
+import time
+import zlib
+import itertools
 from dotenv import load_dotenv
+from helpers import lazy_import
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+try:
+    import zstandard
+except ImportError:  # Optional, trajectory blobs fall back to zlib
+    zstandard = None
 
 load_dotenv()
 
+_replica_rotation = itertools.count()  # Spreads read connections across the replicas
+
+
+def hosts_from_env(variable: str) -> list:
+    """
+    Reads servers from an environment variable holding a comma separated list of host:port entries,
+    e.g. "localhost:3306,localhost:3307".
+
+    :param variable: The name of the environment variable.
+    :return: A list of (host, port) tuples, empty if the variable is not set.
+    """
+    hosts = []
+    for entry in os.getenv(variable, '').split(','):
+        if entry.strip():
+            host, _, port = entry.strip().partition(':')
+            hosts.append((host, int(port) if port else 3306))
+    return hosts
+
 
 class DbConnector:
     """
@@ -23,41 +53,189 @@ class DbConnector:
                  HOST='tdt4225-34.idi.ntnu.no',
                  DATABASE='geolife',
                  USER=os.getenv('DB_USER'),
-                 PASSWORD=os.getenv('DB_PASSWORD')):
-        try:
-            self.db_connection = mysql.connect(host=HOST, database=DATABASE, user=USER, password=PASSWORD, port=3306)
-        except Exception as e:
-            print("ERROR: Failed to connect to db:", e)
+                 PASSWORD=os.getenv('DB_PASSWORD'),
+                 PORT=3306):
+        """
+        Stores the connection arguments. The connection is opened on first use of db_connection or cursor, so
+        constructing a connector costs no round trips to the server.
+        """
+        self.connect_args = {'host': HOST, 'database': DATABASE, 'user': USER, 'password': PASSWORD, 'port': PORT}
+        self._db_connection = None
+        self._cursor = None
 
-        self.cursor = self.db_connection.cursor()
+    @property
+    def db_connection(self):
+        if self._db_connection is None:
+            try:
+                self._db_connection = mysql.connect(**self.connect_args)
+            except Exception as e:
+                print("ERROR: Failed to connect to db:", e)
+                raise
+            print(f"Connected to: {self._db_connection.get_server_info()}, database: {self.connect_args['database']}")
+        return self._db_connection
 
-        print("Connected to:", self.db_connection.get_server_info())
-        self.cursor.execute("select database();")
-        database_name = self.cursor.fetchone()
-        print("You are connected to the database:", database_name)
-        print("-----------------------------------------------\n")
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self._cursor = self.db_connection.cursor()
+        return self._cursor
 
     def get_cursor(self):
         return self.cursor
 
     def close_connection(self):
-        self.cursor.close()
-        self.db_connection.close()
+        if self._db_connection is None:
+            return
+        if self._cursor is not None:
+            self._cursor.close()
+        self._db_connection.close()
         print("\n-----------------------------------------------")
-        print("Connection to %s is closed" % self.db_connection.get_server_info())
+        print("Connection to %s is closed" % self._db_connection.get_server_info())
+        self._db_connection = None
+        self._cursor = None
 
 
 class Database:
-    def __init__(self):
+    def __init__(self, host=None, port=None, role='write', max_replica_lag=None, replica_check_interval=None):
+        """
+        Initializes the Database object. The connection is established and the cursor created on the first query,
+        see DbConnector.
+
+        Connections are routed by role. Writes go to the primary, DB_PRIMARY_HOST (host:port), or the default server
+        of DbConnector if it is not set. Reads go to one of the replicas in DB_REPLICA_HOSTS (comma separated
+        host:port entries), taken in turn by successive read connections. A replica is only used if its replication
+        lag is at most max_replica_lag when the connection is opened, otherwise the next replica is tried, and the
+        primary is used if none qualifies. Long-lived readers re-check the lag with check_replica, and are re-routed
+        once their replica falls behind, or back to a replica once one has caught up.
+
+        :param host: The host of the MySQL server. Omit to route by role.
+        :param port: The port of the MySQL server. Omit to use 3306.
+        :param role: 'write' to connect to the primary, or 'read' to connect to a replica.
+        :param max_replica_lag: Largest replication lag in seconds of a replica to read from. Omit to read it from
+                                DB_MAX_REPLICA_LAG, or use 30 if it is not set.
+        :param replica_check_interval: Seconds between re-checks of the replication lag, see check_replica. Omit to
+                                       read it from DB_REPLICA_CHECK_INTERVAL, or use 30 if it is not set.
+        """
+        if role not in ('write', 'read'):
+            raise ValueError(f"Unknown role: {role}. Use 'write' or 'read'")
+        self.host = host
+        self.port = port
+        self.role = role
+        self.max_replica_lag = float(os.getenv('DB_MAX_REPLICA_LAG', 30) if max_replica_lag is None
+                                     else max_replica_lag)
+        self.replica_check_interval = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 30) if replica_check_interval is None
+                                            else replica_check_interval)
+
+        primary = [(host, port)] if host else hosts_from_env('DB_PRIMARY_HOST')[:1] or [(None, port)]
+        self.primary = self.connector(*primary[0])
+        replicas = hosts_from_env('DB_REPLICA_HOSTS') if role == 'read' and not host else []
+        if replicas:
+            offset = next(_replica_rotation) % len(replicas)
+            replicas = replicas[offset:] + replicas[:offset]
+        self.replicas = [self.connector(replica_host, replica_port) for replica_host, replica_port in replicas]
+        self._connection = None
+        self.checked_at = None  # Time the lag was last checked, see check_replica
+
+    def clone(self) -> Database:
+        """
+        Creates another Database object with the same server and routing, for queries on a separate connection.
+        """
+        return Database(host=self.host, port=self.port, role=self.role, max_replica_lag=self.max_replica_lag,
+                        replica_check_interval=self.replica_check_interval)
+
+    @staticmethod
+    def connector(host=None, port=None) -> DbConnector:
+        connector_args = {}
+        if host:
+            connector_args['HOST'] = host
+        if port:
+            connector_args['PORT'] = port
+        return DbConnector(**connector_args)
+
+    @property
+    def connection(self) -> DbConnector:
+        if self._connection is None:
+            self._connection = self.route()
+        return self._connection
+
+    def route(self) -> DbConnector:
+        """
+        Chooses the server to connect to: the first replica within the lag tolerance, or the primary.
+
+        :return: The DbConnector of the server.
+        """
+        self.checked_at = time.time()
+        for replica in self.replicas:
+            name = f"{replica.connect_args['host']}:{replica.connect_args['port']}"
+            try:
+                lag = self.replica_lag(replica)
+            except Exception as e:
+                print(f"WARNING: Replica {name} is unavailable: {e}")
+                continue
+            if lag is not None and lag <= self.max_replica_lag:
+                return replica
+            print(f"WARNING: Replica {name} is {'not replicating' if lag is None else f'{lag} seconds behind'}")
+            replica.close_connection()
+        if self.replicas:
+            print("WARNING: No replica within the lag tolerance, reading from the primary")
+        return self.primary
+
+    def check_replica(self) -> bool:
+        """
+        Re-checks the replication lag at most every replica_check_interval seconds, and re-routes the connection if
+        its replica has fallen behind, or if it fell back to the primary and a replica has caught up. The lag is read
+        on the query cursor, so only call it between queries.
+
+        :return: True if the connection was re-routed, and the cursor has changed.
+        """
+        if not self.replicas or self._connection is None:
+            return False
+        if time.time() - self.checked_at < self.replica_check_interval:
+            return False
+
+        if self._connection is not self.primary:
+            try:
+                lag = self.replica_lag(self._connection)
+            except Exception as e:
+                print(f"WARNING: Failed to check the replica lag: {e}")
+                lag = None
+            if lag is not None and lag <= self.max_replica_lag:
+                self.checked_at = time.time()
+                return False
+
+        connection = self.route()
+        if connection is self._connection:
+            return False
+        self._connection.close_connection()
+        self._connection = connection
+        return True
+
+    @staticmethod
+    def replica_lag(connector: DbConnector):
         """
-        Initializes the Database object by establishing a database connection and creating a cursor.
+        Reads the replication lag of a server.
+
+        :param connector: The DbConnector of the server.
+        :return: The lag in seconds, or None if the server is not replicating.
         """
+        cursor = connector.cursor
         try:
-            self.connection = DbConnector()
-            self.db_connection = self.connection.db_connection
-            self.cursor = self.connection.cursor
-        except Exception as e:
-            print("ERROR: Failed to use database:", e)
+            cursor.execute("SHOW REPLICA STATUS;")
+        except mysql.Error:
+            cursor.execute("SHOW SLAVE STATUS;")  # Servers before MySQL 8.0.22
+        channels = [dict(zip(cursor.column_names, row)) for row in cursor.fetchall()]
+        lags = [channel.get('Seconds_Behind_Source', channel.get('Seconds_Behind_Master')) for channel in channels]
+        if not lags or None in lags:
+            return None
+        return max(lags)
+
+    @property
+    def db_connection(self):
+        return self.connection.db_connection
+
+    @property
+    def cursor(self):
+        return self.connection.cursor
 
     def create_table(self, table_name: str, attributes: list, primary_key: str, foreign: dict = None, debug=False):
         """
@@ -112,15 +290,24 @@ class Database:
         self.cursor.execute(query)
         self.db_connection.commit()
 
-    def insert_batch(self, table_name: str, batch: list):
+    def insert_batch(self, table_name: str, batch: list, accumulate: list = None, commit=True):
         """
         Inserts a batch of rows into the specified table.
 
         :param table_name: The name of the table to insert data into.
         :param batch: A list of dictionaries, each representing a row to be inserted.
+        :param accumulate: A list of columns to add to the existing row instead of failing when a row with the same
+                           primary key already exists.
+        :param commit: Set to False to insert within a transaction of the caller, see insert_batches. Errors are then
+                       raised, and nothing is committed or rolled back.
+        :return: True if the batch was committed, False if it was rolled back.
         """
+        if not batch:  # e.g. the TrackPoint buffer when trackpoints are stored as blobs
+            return True
+
         try:
-            self.db_connection.start_transaction()
+            if commit:
+                self.db_connection.start_transaction()
             if 'meta' in batch[0].keys():
                 for row in batch:
                     del row['meta']
@@ -130,18 +317,103 @@ class Database:
             columns = ', '.join(df.columns)
             placeholders = ', '.join(['%s'] * len(df.columns))
             query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+            if accumulate:
+                query += " ON DUPLICATE KEY UPDATE " + ', '.join(f'{col} = {col} + VALUES({col})' for col in accumulate)
 
             self.cursor.executemany(query, data)
+            if commit:
+                self.db_connection.commit()
+            return True
+        except mysql.Error as e:
+            if not commit:
+                raise
+            print(f"An error occurred: {e}")
+            self.db_connection.rollback()
+            return False
+
+    def insert_batches(self, batches: list) -> bool:
+        """
+        Inserts batches into several tables in one transaction, so that either every row is committed or none is.
+
+        :param batches: A list of (table_name, batch, accumulate) tuples, inserted in order, see insert_batch.
+        :return: True if the batches were committed, False if they were rolled back.
+        """
+        try:
+            self.db_connection.start_transaction()
+            for table_name, batch, accumulate in batches:
+                self.insert_batch(table_name, batch, accumulate, commit=False)
             self.db_connection.commit()
+            return True
         except mysql.Error as e:
             print(f"An error occurred: {e}")
             self.db_connection.rollback()
+            return False
+
+    @staticmethod
+    def encode_trajectory(date_times: np.ndarray, lat: np.ndarray, lon: np.ndarray, altitude: np.ndarray) -> dict:
+        """
+        Encodes the trackpoints of an activity as compressed binary columns for the TrackBlob table.
+        Each column is stored as little-endian int32 deltas between consecutive values, compressed with zstd if
+        available and zlib otherwise. Coordinates are stored in millionths of a degree.
+
+        :param date_times: The timestamps of the trackpoints as datetime64 values.
+        :param lat: The latitudes of the trackpoints in degrees.
+        :param lon: The longitudes of the trackpoints in degrees.
+        :param altitude: The altitudes of the trackpoints in feet, -777 where invalid.
+        :return: A dictionary containing the TrackBlob columns, except activity_id.
+        """
+        codec = 'zstd' if zstandard else 'zlib'
+        compress = zstandard.ZstdCompressor().compress if zstandard else zlib.compress
+
+        def encode(values):
+            return compress(np.diff(values.astype(np.int64), prepend=0).astype('<i4').tobytes())
+
+        seconds = np.asarray(date_times, dtype='datetime64[s]').astype(np.int64)
+        return {
+            'num_trackpoints': len(seconds),
+            'start_date_time': pd.Timestamp(seconds[0], unit='s').to_pydatetime(),
+            'codec': codec,
+            'date_times': encode(seconds - seconds[0]),
+            'lat': encode(np.round(np.asarray(lat) * 1e6)),
+            'lon': encode(np.round(np.asarray(lon) * 1e6)),
+            'altitude': encode(np.round(np.asarray(altitude)))
+        }
+
+    @staticmethod
+    def decode_trajectory(start_date_time, codec: str, date_times: bytes, lat: bytes, lon: bytes,
+                          altitude: bytes) -> dict:
+        """
+        Decodes a TrackBlob row encoded by encode_trajectory into NumPy arrays.
+
+        :param start_date_time: The start_date_time column.
+        :param codec: The codec column.
+        :param date_times: The date_times column.
+        :param lat: The lat column.
+        :param lon: The lon column.
+        :param altitude: The altitude column.
+        :return: A dictionary of arrays: date_time (datetime64[s]), lat and lon (float64, degrees) and altitude
+                 (float64, feet, NaN where invalid).
+        """
+        decompress = zstandard.ZstdDecompressor().decompress if codec == 'zstd' else zlib.decompress
+
+        def decode(blob):
+            return np.cumsum(np.frombuffer(decompress(blob), dtype='<i4'), dtype=np.int64)
+
+        altitudes = decode(altitude).astype(np.float64)
+        altitudes[altitudes == -777] = np.nan
+        return {
+            'date_time': np.datetime64(start_date_time, 's') + decode(date_times).astype('timedelta64[s]'),
+            'lat': decode(lat) / 1e6,
+            'lon': decode(lon) / 1e6,
+            'altitude': altitudes
+        }
 
     def close_connection(self):
         """
         Closes the database connection.
         """
         try:
-            self.connection.close_connection()
+            if self._connection is not None:
+                self._connection.close_connection()
         except Exception as e:
             print("ERROR: Failed to close database:", e)
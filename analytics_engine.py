@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from helpers import time_elapsed_str, haversine_km
+from part2 import print_result
+
+
+def materialize(database, path='./arrays', batch_size=100000):
+    """
+    Materializes the User, Activity and TrackPoint tables into NumPy column files, which AnalyticsEngine memory-maps.
+    Trackpoints are stored sorted by activity and time, with the trackpoints of activity i in the slice
+    offsets[i]:offsets[i + 1] of each trackpoint column (CSR layout).
+
+    :param database: The Database object to read the tables from.
+    :param path: The directory to write the column files to.
+    :param batch_size: The number of trackpoints fetched per batch. Trackpoints are written straight to the
+                       memory-mapped files, so they are never all held in memory.
+    """
+    start_time = time.time()
+    os.makedirs(path, exist_ok=True)
+    cursor = database.cursor
+
+    # Users
+    cursor.execute("SELECT id, has_labels FROM User ORDER BY id;")
+    users = cursor.fetchall()
+    user_ids = np.array([user[0] for user in users], dtype='U3')
+    np.save(os.path.join(path, 'user_id.npy'), user_ids)
+    np.save(os.path.join(path, 'user_has_labels.npy'), np.array([user[1] is not None for user in users]))
+
+    # Activities
+    cursor.execute("SELECT id, user_id, transportation_mode, start_date_time, end_date_time FROM Activity ORDER BY id;")
+    activities = cursor.fetchall()
+    modes = sorted({activity[2] for activity in activities if activity[2] is not None})
+    mode_codes = {mode: code for code, mode in enumerate(modes)}
+    activity_ids = np.array([activity[0] for activity in activities], dtype=np.uint64)
+    np.save(os.path.join(path, 'activity_id.npy'), activity_ids)
+    np.save(os.path.join(path, 'activity_user.npy'),
+            np.searchsorted(user_ids, np.array([activity[1] for activity in activities], dtype='U3')).astype(np.int32))
+    np.save(os.path.join(path, 'activity_mode.npy'),
+            np.array([mode_codes.get(activity[2], -1) for activity in activities], dtype=np.int16))
+    np.save(os.path.join(path, 'activity_start.npy'),
+            np.array([activity[3] for activity in activities], dtype='datetime64[s]'))
+    np.save(os.path.join(path, 'activity_end.npy'),
+            np.array([activity[4] for activity in activities], dtype='datetime64[s]'))
+    with open(os.path.join(path, 'modes.json'), 'w') as f:
+        json.dump(modes, f)
+
+    # Trackpoints, written batch by batch into preallocated files
+    cursor.execute("SELECT COUNT(*) FROM TrackPoint;")
+    num_trackpoints = cursor.fetchone()[0]
+    columns = {
+        'lat': np.float64,
+        'lon': np.float64,
+        'altitude': np.float32,
+        'date_time': 'datetime64[s]'
+    }
+    files = {name: np.lib.format.open_memmap(os.path.join(path, f'trackpoint_{name}.npy'), mode='w+', dtype=dtype,
+                                             shape=(num_trackpoints,))
+             for name, dtype in columns.items()}
+    counts = np.zeros(len(activity_ids), dtype=np.int64)
+
+    cursor.execute('''SELECT activity_id, lat, lon, altitude, date_time
+                      FROM TrackPoint
+                      ORDER BY activity_id, date_time;''')
+    position = 0
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        end = position + len(batch)
+        batch_activities = np.array([row[0] for row in batch], dtype=np.uint64)
+        counts += np.bincount(np.searchsorted(activity_ids, batch_activities), minlength=len(activity_ids))
+        files['lat'][position:end] = [row[1] for row in batch]
+        files['lon'][position:end] = [row[2] for row in batch]
+        files['altitude'][position:end] = [np.nan if row[3] is None else row[3] for row in batch]
+        files['date_time'][position:end] = np.array([row[4] for row in batch], dtype='datetime64[s]')
+        position = end
+
+    for file in files.values():
+        file.flush()
+    np.save(os.path.join(path, 'activity_offsets.npy'), np.concatenate(([0], np.cumsum(counts))))
+
+    print(f'Materialized {len(user_ids)} users, {len(activity_ids)} activities and {num_trackpoints} trackpoints '
+          f'to {path} in {time_elapsed_str(start_time)}')
+
+
+def round_half_away(values: np.ndarray) -> np.ndarray:
+    """
+    Rounds like MySQL ROUND on exact values, with halves rounded away from zero.
+    """
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+class AnalyticsEngine:
+    def __init__(self, path='./arrays'):
+        """
+        Memory-maps the column files written by materialize. The files are mapped read-only, so any number of
+        processes can share the pages of the same files without copying them.
+
+        :param path: The directory of the column files.
+        """
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+        self.user_id = load('user_id')
+        self.user_has_labels = load('user_has_labels')
+        self.activity_id = load('activity_id')
+        self.activity_user = load('activity_user')
+        self.activity_mode = load('activity_mode')
+        self.activity_start = load('activity_start')
+        self.activity_end = load('activity_end')
+        self.offsets = load('activity_offsets')
+        self.lat = load('trackpoint_lat')
+        self.lon = load('trackpoint_lon')
+        self.altitude = load('trackpoint_altitude')
+        self.date_time = load('trackpoint_date_time')
+        with open(os.path.join(path, 'modes.json')) as f:
+            self.modes = np.array(json.load(f) + [None], dtype=object)  # Code -1 maps to None
+
+    @property
+    def activity_sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def trackpoint_activity(self) -> np.ndarray:
+        """
+        Expands the CSR offsets to the activity index of every trackpoint.
+        """
+        return np.repeat(np.arange(len(self.activity_id)), self.activity_sizes)
+
+    def execute_tasks(self, task_nums: int or range[int] or list[int], **output_options):
+        """
+        Executes and prints the specified tasks, like Part2.execute_tasks.
+
+        :param task_nums: An integer, range, or list of integers representing the task numbers to be executed.
+        :param output_options: sink_format and preview_rows, see print_result.
+        """
+        if isinstance(task_nums, int):
+            task_nums = [task_nums]
+
+        floatfmts = {2: ".2f", 10: ".2f"}
+        for num in task_nums:
+            print(f'Task {num}:')
+            start_time = time.time()
+            result = getattr(self, f'task_{num}')()
+            results = result if isinstance(result, tuple) else (result,)
+            for suffix, table in zip('ab' if len(results) > 1 else [''], results):
+                print_result(table, floatfmt=floatfmts.get(num, ".0f"), filename=f'task_{num}{suffix}',
+                             **output_options)
+            print(f'Time elapsed: {time_elapsed_str(start_time)}\n')
+
+    def task_1(self):
+        return {'Number of Users': [len(self.user_id)],
+                'Number of Activities': [len(self.activity_id)],
+                'Number of TrackPoints': [len(self.lat)]}
+
+    def task_2(self):
+        user_tp = np.bincount(self.activity_user, weights=self.activity_sizes, minlength=len(self.user_id))
+        with_trackpoints = user_tp[user_tp > 0]
+        return {'Average trackpoints per user': [user_tp.sum() / len(self.user_id)],
+                'Maximum trackpoints per user': [int(with_trackpoints.max())],
+                'Minimum trackpoints per user': [int(with_trackpoints.min())]}
+
+    def task_3(self):
+        counts = np.bincount(self.activity_user, minlength=len(self.user_id))
+        top = np.argsort(-counts, kind='stable')[:15]
+        top = top[counts[top] > 0]
+        return pd.DataFrame({'User': self.user_id[top], 'Number of Activities': counts[top]})
+
+    def task_4(self):
+        bus = np.flatnonzero(self.modes == 'bus')
+        users = np.unique(self.activity_user[np.isin(self.activity_mode, bus)])
+        return pd.DataFrame({'User who have used a bus': self.user_id[users]})
+
+    def task_5(self):
+        labeled = self.activity_mode >= 0
+        pairs = np.unique(np.column_stack((self.activity_user[labeled], self.activity_mode[labeled])), axis=0)
+        counts = np.bincount(pairs[:, 0], minlength=len(self.user_id)) if len(pairs) else np.zeros(len(self.user_id))
+        users = np.unique(self.activity_user)
+        top = users[np.argsort(-counts[users], kind='stable')[:10]]
+        return pd.DataFrame({'User': self.user_id[top], 'Unique transportation modes': counts[top].astype(int)})
+
+    def task_6(self):
+        activities = pd.DataFrame({'User': self.user_id[self.activity_user],
+                                   'Transportation Mode': self.modes[self.activity_mode],
+                                   'Start': np.asarray(self.activity_start), 'End': np.asarray(self.activity_end)})
+        counts = activities.groupby(['User', 'Transportation Mode', 'Start', 'End'], dropna=False).size()
+        return counts[counts > 1].reset_index(name='Number of Duplicates')
+
+    def multiple_day_activities(self) -> np.ndarray:
+        """
+        Finds the activities that end the day after they start, like DATEDIFF(end_date_time, start_date_time) = 1.
+        """
+        days = self.activity_end.astype('datetime64[D]') - self.activity_start.astype('datetime64[D]')
+        return np.flatnonzero(days == np.timedelta64(1, 'D'))
+
+    def task_7(self):
+        activities = self.multiple_day_activities()
+        count = {"Number of multi-day activity users": [len(np.unique(self.activity_user[activities]))]}
+
+        minutes = (self.activity_end[activities] - self.activity_start[activities]).astype(np.int64) // 60
+        order = np.lexsort((-minutes, self.activity_user[activities]))
+        activities, minutes = activities[order], minutes[order]
+        listing = pd.DataFrame({'User': self.user_id[self.activity_user[activities]],
+                                'Activity ID': self.activity_id[activities],
+                                'Transportation Mode': self.modes[self.activity_mode[activities]],
+                                'Activity duration (minutes)': minutes})
+        return count, listing
+
+    def time_close_pairs(self) -> tuple:
+        """
+        Finds pairs of activities of different users that overlap in time, allowing 30 seconds between them.
+
+        :return: A tuple of two arrays of activity indices.
+        """
+        order = np.argsort(self.activity_start, kind='stable')
+        starts = self.activity_start[order]
+        ends = self.activity_end[order] + np.timedelta64(30, 's')
+        # Every later starting activity that starts before this one ends overlaps with it
+        stops = np.searchsorted(starts, ends, side='right')
+        num_following = np.maximum(stops - np.arange(len(order)) - 1, 0)
+        first = np.repeat(np.arange(len(order)), num_following)
+        second = first + 1 + (np.arange(num_following.sum()) - np.repeat(np.cumsum(num_following) - num_following,
+                                                                            num_following))
+        first, second = order[first], order[second]
+        different_users = self.activity_user[first] != self.activity_user[second]
+        return first[different_users], second[different_users]
+
+    def spatially_close(self, first: int, second: int, chunk_size=500) -> bool:
+        """
+        Checks whether any trackpoints of two activities are within 50 meters of each other, combining the haversine
+        distance with the altitude difference like Part2.get_users_in_proximity.
+        """
+        a = slice(self.offsets[first], self.offsets[first + 1])
+        b = slice(self.offsets[second], self.offsets[second + 1])
+        lat_a, lon_a, alt_a = self.lat[a], self.lon[a], self.altitude[a]
+        lat_b, lon_b, alt_b = self.lat[b], self.lon[b], self.altitude[b]
+        if len(lat_a) == 0 or len(lat_b) == 0:
+            return False
+
+        # Only points within the bounding box of the other activity, widened by the search window, can be close
+        in_a = ((lat_a >= lat_b.min() - 0.0005) & (lat_a <= lat_b.max() + 0.0005) &
+                (lon_a >= lon_b.min() - 0.0005) & (lon_a <= lon_b.max() + 0.0005))
+        in_b = ((lat_b >= lat_a.min() - 0.0005) & (lat_b <= lat_a.max() + 0.0005) &
+                (lon_b >= lon_a.min() - 0.0005) & (lon_b <= lon_a.max() + 0.0005))
+        lat_a, lon_a, alt_a = lat_a[in_a], lon_a[in_a], alt_a[in_a]
+        lat_b, lon_b, alt_b = lat_b[in_b], lon_b[in_b], alt_b[in_b]
+
+        for start in range(0, len(lat_b), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            lat_c, lon_c, alt_c = lat_b[chunk, None], lon_b[chunk, None], alt_b[chunk, None]
+            window = (np.abs(lat_a - lat_c) <= 0.0005) & (np.abs(lon_a - lon_c) <= 0.0005)
+            if not window.any():
+                continue
+            coord_dist = haversine_km(lat_a, lon_a, lat_c, lon_c) * 1000
+            altitude_dist = np.abs(alt_c - alt_a) * 0.3048
+            if (window & (np.sqrt(coord_dist ** 2 + altitude_dist ** 2) <= 50)).any():
+                return True
+        return False
+
+    def task_8(self):
+        first, second = self.time_close_pairs()
+        close_users = set()
+        for a, b in zip(first, second):
+            users = (self.activity_user[a], self.activity_user[b])
+            if (users[0] not in close_users or users[1] not in close_users) and self.spatially_close(a, b):
+                close_users.update(users)
+        return {"Users which have been close to another user": [len(close_users)]}
+
+    def task_9(self):
+        valid = np.flatnonzero(~np.isnan(self.altitude))
+        activity = self.trackpoint_activity()[valid]
+        same_activity = activity[1:] == activity[:-1]
+        gains = np.diff(self.altitude[valid].astype(np.float64))[same_activity]
+        users = self.activity_user[activity[1:][same_activity]]
+
+        totals = np.bincount(users, weights=np.maximum(gains, 0), minlength=len(self.user_id))
+        has_pairs = np.bincount(users, minlength=len(self.user_id)) > 0
+        meters = round_half_away(totals * 0.3048)
+        candidates = np.flatnonzero(has_pairs)
+        top = candidates[np.argsort(-meters[candidates], kind='stable')[:15]]
+        return pd.DataFrame({'User': self.user_id[top], 'Altitude Gained (meters)': meters[top]})
+
+    def task_10(self):
+        durations = (self.activity_end - self.activity_start).astype(np.int64)
+        activities = np.flatnonzero(durations <= 86400)
+        sizes = self.activity_sizes[activities]
+        activity = np.repeat(activities, sizes)
+        # Position of every trackpoint of the selected activities, slice by slice
+        points = np.repeat(self.offsets[activities] - (np.cumsum(sizes) - sizes), sizes) + np.arange(sizes.sum())
+
+        user = self.activity_user[activity]
+        mode = self.activity_mode[activity]
+        day = self.activity_start[activity].astype('datetime64[D]')
+        order = np.lexsort((self.date_time[points], mode, user))
+        points, user, mode, day = points[order], user[order], mode[order], day[order]
+
+        consecutive = (user[1:] == user[:-1]) & (mode[1:] == mode[:-1]) & (day[1:] == day[:-1])
+        distances = haversine_km(self.lat[points[:-1]], self.lon[points[:-1]], self.lat[points[1:]],
+                                 self.lon[points[1:]])[consecutive]
+        totals = pd.Series(distances).groupby([user[1:][consecutive], mode[1:][consecutive]], sort=True).sum()
+
+        output = []
+        for current_mode, group in totals.groupby(level=1, sort=False):
+            (best_user, _), distance = group.idxmax(), group.max()
+            output.append([self.user_id[best_user], self.modes[current_mode], distance])
+        return pd.DataFrame(output, columns=['User ID', 'Transportation Mode', 'Distance in km'])
+
+    def task_11(self):
+        activity = self.trackpoint_activity()
+        same_activity = activity[1:] == activity[:-1]
+        gaps = np.diff(self.date_time.astype(np.int64))
+        invalid = np.unique(activity[1:][same_activity & (gaps >= 300)])
+        counts = np.bincount(self.activity_user[invalid], minlength=len(self.user_id))
+        users = np.flatnonzero(counts)
+        return pd.DataFrame({'User ID': self.user_id[users], 'Invalid Activities': counts[users]})
+
+    def task_12(self):
+        labeled = (self.activity_mode >= 0) & self.user_has_labels[self.activity_user]
+        counts = pd.DataFrame({'user': self.activity_user[labeled],
+                               'mode': self.modes[self.activity_mode[labeled]]}).value_counts().reset_index()
+        counts = counts.sort_values(['user', 'count', 'mode'], ascending=[True, False, True])
+        top = counts.drop_duplicates('user')
+        return pd.DataFrame({'User ID': self.user_id[top['user'].to_numpy()],
+                             'Most Used Transportation Mode': top['mode'].to_numpy(),
+                             'Amount': top['count'].to_numpy()})
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+Z_95 = 1.959964  # Standard normal quantile of a two-sided 95 % confidence interval
+
+
+def approximation_settings(sample_rate=0.1, sample_level='activity', decimation=1, seed=0) -> dict:
+    """
+    Validates and collects the settings of an approximate run.
+
+    :param sample_rate: Fraction of activities or users to include, between 0 and 1.
+    :param sample_level: 'activity' to sample activities independently, 'user' to sample whole users.
+    :param decimation: Keep every decimation-th trackpoint of each activity. 1 keeps all trackpoints.
+    :param seed: Seed of the sample. The same seed always selects the same activities or users.
+    :return: A dictionary of the settings.
+    """
+    if not 0 < sample_rate <= 1:
+        raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+    if sample_level not in ('activity', 'user'):
+        raise ValueError(f"Unknown sample level: {sample_level}. Use 'activity' or 'user'")
+    if int(decimation) < 1:
+        raise ValueError(f"decimation must be at least 1, got {decimation}")
+    return {'sample_rate': sample_rate, 'sample_level': sample_level, 'decimation': int(decimation), 'seed': seed}
+
+
+def sampling_condition(approximation: dict, activity_column='Activity.id', user_column='Activity.user_id') -> tuple:
+    """
+    Builds a deterministic sampling predicate, hashing the activity or user id with the seed.
+
+    :param approximation: Settings from approximation_settings.
+    :param activity_column: The column holding the activity id.
+    :param user_column: The column holding the user id.
+    :return: A tuple containing the SQL condition and its parameters.
+    """
+    column = activity_column if approximation['sample_level'] == 'activity' else user_column
+    return (f"MOD(CRC32(CONCAT(%s, '-', {column})), 1000000) < %s",
+            [str(approximation['seed']), int(round(approximation['sample_rate'] * 1000000))])
+
+
+def decimation_condition(approximation: dict, trackpoint_column='TrackPoint.id') -> tuple:
+    """
+    Builds the predicate keeping every decimation-th trackpoint. Trackpoint ids are assigned in file order during
+    insertion, so this keeps evenly spaced trackpoints of each activity.
+
+    :param approximation: Settings from approximation_settings.
+    :param trackpoint_column: The column holding the trackpoint id.
+    :return: A tuple containing the SQL condition and its parameters.
+    """
+    return f"MOD({trackpoint_column}, %s) = 0", [approximation['decimation']]
+
+
+def estimate_totals(contributions: pd.DataFrame, group_by: list, value: str, approximation: dict) -> pd.DataFrame:
+    """
+    Estimates group totals from the per-activity contributions of a sample, with a normal approximation 95 %
+    confidence interval.
+
+    With activity sampling the Horvitz-Thompson estimator is used: each sampled activity is weighted by
+    1 / sample_rate, with variance (1 - p) / p^2 times the sum of squared contributions. The contributions are
+    non-negative, so the observed sum is a hard lower bound of the interval. With user sampling every activity of a
+    sampled user is included, so the totals of the sampled users are exact, but users outside the sample are missing
+    and may belong in any ranking of the groups. No interval is given then, and the rows are labeled as covering the
+    sampled users only.
+
+    Decimation is not covered by the interval: dropping trackpoints shortens distances and smooths altitude profiles,
+    so decimated estimates are biased downwards.
+
+    :param contributions: One row per sampled activity with the group columns and the contribution in value.
+    :param group_by: The columns identifying a group.
+    :param value: The column holding the contributions.
+    :param approximation: Settings from approximation_settings.
+    :return: One row per group with the columns in group_by, estimate, ci_low, ci_high (NaN with user sampling) and
+             bound, describing the interval.
+    """
+    grouped = contributions.groupby(group_by, dropna=False)[value]
+    observed = grouped.sum()
+    if approximation['sample_level'] == 'user':
+        return pd.DataFrame({'estimate': observed, 'ci_low': np.nan, 'ci_high': np.nan,
+                             'bound': 'sampled users only, no bound'}).reset_index()
+
+    p = approximation['sample_rate']
+    estimate = observed / p
+    half_width = Z_95 * np.sqrt((1 - p) / p ** 2 * grouped.apply(lambda values: (values ** 2).sum()))
+    return pd.DataFrame({'estimate': estimate,
+                         'ci_low': np.maximum(estimate - half_width, observed),
+                         'ci_high': estimate + half_width,
+                         'bound': '95 % CI'}).reset_index()
@@ -1,5 +1,91 @@
+import io
+import re
+import hashlib
+import tarfile
+import zipfile
+import functools
+from itertools import repeat
+import numpy as np
 import pandas as pd
 import os
+from Database import Database
+from similarity import resample_polyline, encode_polyline, point_distances
+
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# Member names of the Geolife archive, e.g. "Geolife Trajectories 1.3/Data/000/Trajectory/20081023025304.plt"
+ARCHIVE_ACTIVITY = re.compile(r'^(.*?Data/(\d{3}))/Trajectory/[^/]+\.plt$')
+ARCHIVE_LABELS = re.compile(r'^(.*?Data/(\d{3}))/labels\.txt$')
+
+_archive_handles = {}  # Open archive handles of each process, see read_member
+
+
+def is_archive(path: str) -> bool:
+    """
+    Checks whether a data path is a zip or tar archive rather than an extracted directory.
+    """
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+@functools.lru_cache(maxsize=None)
+def archive_members(archive_path: str) -> tuple:
+    """
+    Lists the files in an archive, in archive order. Listing a zip archive only reads its central directory, while
+    a tar archive is read through once.
+
+    :param archive_path: The path to the archive.
+    :return: A tuple of member names.
+    """
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            return tuple(info.filename for info in archive.infolist() if not info.is_dir())
+    with tarfile.open(archive_path, 'r|*') as archive:
+        return tuple(member.name for member in archive if member.isfile())
+
+
+@functools.lru_cache(maxsize=None)
+def archive_positions(archive_path: str) -> dict:
+    """
+    Maps the member names of an archive to their position in archive order, see archive_members.
+    """
+    return {name: position for position, name in enumerate(archive_members(archive_path))}
+
+
+def read_member(archive_path: str, name: str) -> bytes:
+    """
+    Reads and decompresses a member of an archive into memory, without writing it to disk. Every process opens its
+    own handle, so worker processes read members independently.
+
+    :param archive_path: The path to the archive.
+    :param name: The name of the member.
+    :return: The content of the member.
+    """
+    key = (os.getpid(), archive_path)
+    if key not in _archive_handles:
+        if zipfile.is_zipfile(archive_path):
+            _archive_handles[key] = zipfile.ZipFile(archive_path)
+        else:
+            _archive_handles[key] = tarfile.open(archive_path, 'r:*')
+    archive = _archive_handles[key]
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.read(name)
+    return archive.extractfile(name).read()
+
+
+def open_source(meta: dict):
+    """
+    Opens the file of a user or activity row for reading, whether it is extracted or in an archive.
+
+    :param meta: The meta dictionary of the row, with the path and, for archives, the archive path or the
+                 content read in advance.
+    :return: A path or a file-like object.
+    """
+    if 'data' in meta:
+        return io.BytesIO(meta['data'])
+    if 'archive' in meta:
+        return io.BytesIO(read_member(meta['archive'], meta['path']))
+    return meta['path']
 
 
 def read_file_to_list(file_path: str) -> list:
@@ -18,45 +104,154 @@ def read_file_to_list(file_path: str) -> list:
         return None
 
 
-def process_users(path: str, labeled_ids: list) -> list:
+def subset_settings(user_ids=None, max_users=None, user_sample_rate=None, time_range=None,
+                    max_activities_per_user=None, seed=0) -> dict:
+    """
+    Validates and collects the filter of a subset ingest, applied by process_users and preprocess_activities before
+    any file is parsed.
+
+    :param user_ids: A collection of user IDs to include. Omit to include all users.
+    :param max_users: Number of users to include, the lowest user IDs after the other user filters. Omit to include
+                      all.
+    :param user_sample_rate: Fraction of users to include, between 0 and 1, sampled by hashing the user ID with the
+                             seed. Omit to include all.
+    :param time_range: Tuple (start, end) of date times, end exclusive. Only activities starting in the range are
+                       included. Omit to include all.
+    :param max_activities_per_user: Number of activities to include per user, the earliest ones. Omit to include all.
+    :param seed: Seed of the user sample. The same seed always selects the same users.
+    :return: A dictionary of the settings, with JSON-serializable values.
+    """
+    if user_sample_rate is not None and not 0 < user_sample_rate <= 1:
+        raise ValueError(f"user_sample_rate must be in (0, 1], got {user_sample_rate}")
+    if max_users is not None and max_users < 1:
+        raise ValueError(f"max_users must be at least 1, got {max_users}")
+    if max_activities_per_user is not None and max_activities_per_user < 1:
+        raise ValueError(f"max_activities_per_user must be at least 1, got {max_activities_per_user}")
+    return {
+        'user_ids': sorted(user_ids) if user_ids is not None else None,
+        'max_users': max_users,
+        'user_sample_rate': user_sample_rate,
+        'time_range': [str(pd.Timestamp(time)) for time in time_range] if time_range else None,
+        'max_activities_per_user': max_activities_per_user,
+        'seed': seed
+    }
+
+
+def sampled(key: str, rate: float, seed=0) -> bool:
+    """
+    Decides deterministically whether a key is in a sample.
+
+    :param key: The key to decide for, e.g. a user ID.
+    :param rate: Fraction of keys in the sample.
+    :param seed: Seed of the sample.
+    :return: True if the key is in the sample.
+    """
+    digest = hashlib.sha1(f'{seed}-{key}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') < rate * 2 ** 64
+
+
+def process_users(path: str, labeled_ids: list, subset: dict = None) -> list:
     """
     Processes user directories and returns a list of user data.
 
-    :param path: The path to the user directories.
-    :param labeled_ids: A list of labeled user IDs.
+    :param path: The path to the user directories, or to a zip or tar archive of the dataset.
+    :param labeled_ids: A list of labeled user IDs. For archives, omit to detect them from the labels.txt members.
+    :param subset: The user filters of a subset ingest, see subset_settings. Omit to include all users.
     :return: A list of dictionaries, each containing user data.
     """
     user_rows = []
-    with os.scandir(path) as users:
-        for user in users:
-            if user.is_dir():
-                user_row = {
-                    "id": user.name,
-                    "has_labels": user.name in labeled_ids,
-                    "meta": {"path": user.path}
-                }
-                user_rows.append(user_row)
+    if is_archive(path):
+        members = archive_members(path)
+        user_paths = {}  # User ID: path of the user directory in the archive, in archive order
+        for name in members:
+            match = ARCHIVE_ACTIVITY.match(name)
+            if match:
+                user_paths.setdefault(match.group(2), match.group(1))
+        if labeled_ids is None:
+            labeled_ids = [match.group(2) for match in map(ARCHIVE_LABELS.match, members) if match]
+        for user_id, user_path in user_paths.items():
+            user_row = {
+                "id": user_id,
+                "has_labels": user_id in labeled_ids,
+                "meta": {"path": user_path, "archive": path}
+            }
+            user_rows.append(user_row)
+    else:
+        with os.scandir(path) as users:
+            for user in users:
+                if user.is_dir():
+                    user_row = {
+                        "id": user.name,
+                        "has_labels": user.name in labeled_ids,
+                        "meta": {"path": user.path}
+                    }
+                    user_rows.append(user_row)
+
+    if subset:
+        if subset['user_ids'] is not None:
+            user_ids = set(subset['user_ids'])
+            user_rows = [user_row for user_row in user_rows if user_row['id'] in user_ids]
+        if subset['user_sample_rate'] is not None:
+            user_rows = [user_row for user_row in user_rows
+                         if sampled(user_row['id'], subset['user_sample_rate'], subset['seed'])]
+        if subset['max_users'] is not None:
+            user_rows = sorted(user_rows, key=lambda user_row: user_row['id'])[:subset['max_users']]
     return user_rows
 
 
-def preprocess_activities(user_row: dict) -> list:
+def activity_start_time(file_name: str) -> pd.Timestamp:
+    """
+    Reads the start time of an activity from its PLT file name, which is formatted YYYYMMDDHHMMSS.plt.
+
+    :param file_name: The name of the PLT file.
+    :return: The start time.
+    """
+    return pd.Timestamp(f'{file_name[:4]}-{file_name[4:6]}-{file_name[6:8]} '
+                        f'{file_name[8:10]}:{file_name[10:12]}:{file_name[12:14]}')
+
+
+def preprocess_activities(user_row: dict, subset: dict = None) -> list:
     """
     Processes activity files and returns a list of activity data.
 
     :param user_row: A dictionary containing user data.
+    :param subset: The activity filters of a subset ingest, see subset_settings. Omit to include all activities.
     :return: A list of dictionaries, each containing activity data.
     """
     activity_rows = []
-    with os.scandir(user_row['meta']['path'] + "/Trajectory") as activities:
-        for activity in activities:
-            if activity.is_file():
+    if 'archive' in user_row['meta']:
+        archive_path = user_row['meta']['archive']
+        prefix = user_row['meta']['path'] + "/Trajectory/"
+        for name in archive_members(archive_path):
+            if name.startswith(prefix) and ARCHIVE_ACTIVITY.match(name):
                 activity_row = {
-                    "id": int(activity.name[:-4] + user_row["id"]),
+                    "id": int(os.path.basename(name)[:-4] + user_row["id"]),
                     "user_id": user_row["id"],
                     "transportation_mode": None,
-                    "meta": {"path": activity.path}
+                    "meta": {"path": name, "archive": archive_path}
                 }
                 activity_rows.append(activity_row)
+    else:
+        with os.scandir(user_row['meta']['path'] + "/Trajectory") as activities:
+            for activity in activities:
+                if activity.is_file():
+                    activity_row = {
+                        "id": int(activity.name[:-4] + user_row["id"]),
+                        "user_id": user_row["id"],
+                        "transportation_mode": None,
+                        "meta": {"path": activity.path}
+                    }
+                    activity_rows.append(activity_row)
+
+    if subset:
+        if subset['time_range']:
+            start, end = (pd.Timestamp(time) for time in subset['time_range'])
+            activity_rows = [activity_row for activity_row in activity_rows
+                             if start <= activity_start_time(os.path.basename(activity_row['meta']['path'])) < end]
+        if subset['max_activities_per_user'] is not None:
+            # File names start with the start time, so sorting by path sorts by time
+            activity_rows = sorted(activity_rows, key=lambda activity_row: activity_row['meta']['path'])
+            activity_rows = activity_rows[:subset['max_activities_per_user']]
     return activity_rows
 
 
@@ -69,7 +264,8 @@ def process_activity(user_row: dict, activity_row: dict) -> tuple:
     :return: A tuple containing the expanded activity data and trackpoints data frame.
     """
     columns = ['lat', 'lon', 'dep1', 'alt', 'date', 'date_str', 'time_str']
-    trackpoints_df = pd.read_table(activity_row['meta']['path'], skiprows=6, names=columns, delimiter=',')
+    trackpoints_df = pd.read_table(open_source(activity_row['meta']), skiprows=6, names=columns, delimiter=',')
+    activity_row['meta'].pop('data', None)  # Content read in advance, see process_activities
 
     if trackpoints_df.shape[0] > 2500:
         return None, None
@@ -80,7 +276,11 @@ def process_activity(user_row: dict, activity_row: dict) -> tuple:
         trackpoints_df['date_str'].iloc[-1] + " " + trackpoints_df['time_str'].iloc[-1])
 
     if user_row['has_labels']:
-        transportations = pd.read_table(user_row['meta']['path'] + "/labels.txt")
+        if 'labels' in user_row['meta']:  # Read in advance, see process_activities
+            transportations = pd.read_table(io.BytesIO(user_row['meta']['labels']))
+        else:
+            transportations = pd.read_table(open_source({**user_row['meta'],
+                                                         'path': user_row['meta']['path'] + "/labels.txt"}))
         transportations['Start Time'] = pd.to_datetime(transportations['Start Time'])
         transportations['End Time'] = pd.to_datetime(transportations['End Time'])
 
@@ -98,6 +298,47 @@ def process_activity(user_row: dict, activity_row: dict) -> tuple:
     return activity_row, trackpoints_df
 
 
+def process_activities(user_row: dict, activity_rows: list, executor=None):
+    """
+    Processes the activities of a user with process_activity, in the worker processes of an executor if given.
+
+    Members of a zip archive are read and decompressed by the workers, each through its own handle. A compressed tar
+    archive is a single stream that can only be decompressed in order, and seeking backwards restarts the
+    decompression, so the members of the user, including labels.txt, are read here in archive order and only parsed
+    by the workers. Nothing is written to disk in either case. The labels of a user are read once here, not per
+    activity, whether the dataset is extracted or in an archive.
+
+    :param user_row: A dictionary containing user data.
+    :param activity_rows: A list of dictionaries containing activity data, see preprocess_activities.
+    :param executor: A concurrent.futures.ProcessPoolExecutor. Omit to process the activities in this process.
+    :return: Generator of the tuples returned by process_activity, in the order of activity_rows.
+    """
+    archive_path = user_row['meta'].get('archive')
+    labels_path = user_row['meta']['path'] + "/labels.txt"
+    if archive_path and not zipfile.is_zipfile(archive_path):
+        positions = archive_positions(archive_path)
+        members = [(activity_row['meta'], activity_row['meta']['path']) for activity_row in activity_rows]
+        if user_row['has_labels'] and 'labels' not in user_row['meta']:
+            members.append((None, labels_path))
+        for meta, name in sorted(members, key=lambda member: positions[member[1]]):
+            if meta is None:
+                user_row['meta']['labels'] = read_member(archive_path, name)
+            else:
+                meta['data'] = read_member(archive_path, name)
+    elif archive_path and user_row['has_labels'] and 'labels' not in user_row['meta']:
+        user_row['meta']['labels'] = read_member(archive_path, labels_path)
+    elif user_row['has_labels'] and 'labels' not in user_row['meta']:
+        with open(labels_path, 'rb') as f:
+            user_row['meta']['labels'] = f.read()
+
+    if executor is None:
+        for activity_row in activity_rows:
+            yield process_activity(user_row, activity_row=activity_row)
+        return
+
+    yield from executor.map(process_activity, repeat(user_row), activity_rows, chunksize=16)
+
+
 def process_trackpoint(activity_id: int, trackpoint_row: pd.Series) -> dict:
     """
     Processes a trackpoint and returns the trackpoint data.
@@ -114,3 +355,185 @@ def process_trackpoint(activity_id: int, trackpoint_row: pd.Series) -> dict:
         'date_days': trackpoint_row['date'],
         'date_time': trackpoint_row['date_str'] + " " + trackpoint_row['time_str']
     }
+
+
+def process_track_blob(activity_id: int, trackpoints_df: pd.DataFrame) -> dict:
+    """
+    Processes the trackpoints of an activity into one compressed TrackBlob row, see Database.encode_trajectory.
+
+    :param activity_id: The ID of the activity.
+    :param trackpoints_df: A pandas DataFrame containing the trackpoints of the activity.
+    :return: A dictionary containing the TrackBlob data.
+    """
+    date_times = pd.to_datetime(trackpoints_df['date_str'] + " " + trackpoints_df['time_str']).to_numpy()
+    return {
+        'activity_id': activity_id,
+        **Database.encode_trajectory(date_times, trackpoints_df['lat'].to_numpy(), trackpoints_df['lon'].to_numpy(),
+                                     trackpoints_df['alt'].to_numpy())
+    }
+
+
+def fingerprint_activity(activity_row: dict, trackpoints_df: pd.DataFrame) -> tuple:
+    """
+    Computes a content fingerprint of an activity, used to detect re-exported or copied trajectories at ingest.
+    Two activities share a fingerprint when they have the same start and end time, the same number of trackpoints
+    and the same sequence of coordinates, regardless of file name or user.
+
+    :param activity_row: A dictionary containing the processed activity data.
+    :param trackpoints_df: A pandas DataFrame containing the trackpoints of the activity.
+    :return: A hashable tuple identifying the trackpoint content of the activity.
+    """
+    coordinates = trackpoints_df[['lat', 'lon']].to_numpy(dtype='float64')
+    coordinate_hash = hashlib.sha1(coordinates.tobytes()).hexdigest()
+    return (activity_row['start_date_time'], activity_row['end_date_time'], trackpoints_df.shape[0],
+            coordinate_hash)
+
+
+def compute_density_counts(activity_row: dict, trackpoints_df: pd.DataFrame, resolutions: tuple) -> pd.DataFrame:
+    """
+    Counts the trackpoints of an activity per grid cell and hour, at each of the given grid resolutions.
+    A cell is identified by the latitude and longitude divided by the resolution, rounded down.
+
+    :param activity_row: A dictionary containing the processed activity data.
+    :param trackpoints_df: A pandas DataFrame containing the trackpoints of the activity.
+    :param resolutions: The grid resolutions in degrees.
+    :return: A pandas DataFrame with one row per (resolution, cell_lat, cell_lon, hour, transportation_mode, user_id)
+             and the number of trackpoints in point_count.
+    """
+    hours = trackpoints_df['date_str'] + " " + trackpoints_df['time_str'].str[:2] + ":00:00"
+    frames = []
+    for resolution in resolutions:
+        cells = pd.DataFrame({
+            'cell_lat': np.floor(trackpoints_df['lat'].to_numpy() / resolution).astype(np.int64),
+            'cell_lon': np.floor(trackpoints_df['lon'].to_numpy() / resolution).astype(np.int64),
+            'hour': hours
+        })
+        counts = cells.groupby(['cell_lat', 'cell_lon', 'hour']).size().reset_index(name='point_count')
+        counts.insert(0, 'resolution', resolution)
+        frames.append(counts)
+
+    density_df = pd.concat(frames, ignore_index=True)
+    density_df['transportation_mode'] = activity_row['transportation_mode'] or ''  # Unlabeled activities
+    density_df['user_id'] = activity_row['user_id']
+    return density_df
+
+
+def compute_signature(activity_row: dict, trackpoints_df: pd.DataFrame, num_points=32, cell_size=0.01) -> dict:
+    """
+    Computes the compact signature of an activity used for similarity search.
+
+    :param activity_row: A dictionary containing the processed activity data.
+    :param trackpoints_df: A pandas DataFrame containing the trackpoints of the activity.
+    :param num_points: The number of points in the resampled polyline.
+    :param cell_size: The size of the start and end cells in degrees.
+    :return: A dictionary containing the signature data.
+    """
+    lat = trackpoints_df['lat'].to_numpy(dtype='float64')
+    lon = trackpoints_df['lon'].to_numpy(dtype='float64')
+    return {
+        'activity_id': activity_row['id'],
+        'min_lat': lat.min(),
+        'max_lat': lat.max(),
+        'min_lon': lon.min(),
+        'max_lon': lon.max(),
+        'start_cell_lat': int(np.floor(lat[0] / cell_size)),
+        'start_cell_lon': int(np.floor(lon[0] / cell_size)),
+        'end_cell_lat': int(np.floor(lat[-1] / cell_size)),
+        'end_cell_lon': int(np.floor(lon[-1] / cell_size)),
+        'polyline': encode_polyline(resample_polyline(lat, lon, num_points))
+    }
+
+
+def detect_stay_points(lat: np.ndarray, lon: np.ndarray, times: np.ndarray, distance_threshold=200,
+                       time_threshold=20 * 60, chunk_size=64) -> list:
+    """
+    Detects stay points, where a user has stayed within distance_threshold meters of a point for at least
+    time_threshold seconds. The distances from each anchor point are computed in chunks of following points, up to
+    the first point outside the stay, so that moving activities stay close to linear time.
+
+    :param lat: Latitudes of the trackpoints in degrees.
+    :param lon: Longitudes of the trackpoints in degrees.
+    :param times: Timestamps of the trackpoints in seconds, in ascending order.
+    :param distance_threshold: The largest distance in meters from the first point of a stay.
+    :param time_threshold: The shortest duration in seconds of a stay.
+    :param chunk_size: Number of points in the first chunk after an anchor. Later chunks double in size.
+    :return: A list of (first index, last index) tuples, one for each stay point.
+    """
+    points = np.column_stack((lat, lon))
+    stays = []
+    i = 0
+    # A stay is impossible once the rest of the track is shorter than time_threshold
+    while i < len(points) - 1 and times[-1] - times[i] >= time_threshold:
+        j = len(points)  # First point outside the stay
+        start, size = i + 1, chunk_size
+        while start < len(points):
+            distances = point_distances(points[i], points[start:start + size])
+            outside = np.flatnonzero(distances > distance_threshold)
+            if len(outside):
+                j = start + outside[0]
+                break
+            start, size = start + size, size * 2
+        if times[j - 1] - times[i] >= time_threshold:
+            stays.append((i, j - 1))
+            i = j
+        else:
+            i += 1
+    return stays
+
+
+def split_trips(times: np.ndarray, gap_threshold=5 * 60) -> list:
+    """
+    Splits a trajectory into trip segments wherever consecutive trackpoints are gap_threshold seconds or more apart.
+
+    :param times: Timestamps of the trackpoints in seconds, in ascending order.
+    :param gap_threshold: The shortest gap in seconds that splits two segments.
+    :return: A list of (first index, last index) tuples, one for each segment.
+    """
+    gaps = np.flatnonzero(np.diff(times) >= gap_threshold)
+    starts = np.concatenate(([0], gaps + 1))
+    ends = np.concatenate((gaps, [len(times) - 1]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def compute_segments(activity_row: dict, trackpoints_df: pd.DataFrame, gap_threshold=5 * 60, distance_threshold=200,
+                     time_threshold=20 * 60) -> tuple:
+    """
+    Segments an activity into stay points and trip segments, see detect_stay_points and split_trips.
+
+    :param activity_row: A dictionary containing the processed activity data.
+    :param trackpoints_df: A pandas DataFrame containing the trackpoints of the activity.
+    :param gap_threshold: The shortest gap in seconds between two trip segments.
+    :param distance_threshold: The largest distance in meters from the first point of a stay point.
+    :param time_threshold: The shortest duration in seconds of a stay point.
+    :return: A tuple containing a list of stay point rows and a list of trip segment rows.
+    """
+    date_times = pd.to_datetime(trackpoints_df['date_str'] + " " + trackpoints_df['time_str'])
+    order = np.argsort(date_times.to_numpy(), kind='stable')
+    date_times = date_times.iloc[order].reset_index(drop=True)
+    times = date_times.to_numpy().astype('datetime64[s]').astype(np.int64)
+    lat = trackpoints_df['lat'].to_numpy(dtype='float64')[order]
+    lon = trackpoints_df['lon'].to_numpy(dtype='float64')[order]
+
+    stay_point_rows = []
+    for first, last in detect_stay_points(lat, lon, times, distance_threshold, time_threshold):
+        stay_point_rows.append({
+            'activity_id': activity_row['id'],
+            'lat': lat[first:last + 1].mean(),
+            'lon': lon[first:last + 1].mean(),
+            'arrival_date_time': date_times[first],
+            'departure_date_time': date_times[last],
+            'num_trackpoints': int(last - first + 1)
+        })
+
+    trip_segment_rows = []
+    for segment_index, (first, last) in enumerate(split_trips(times, gap_threshold)):
+        trip_segment_rows.append({
+            'activity_id': activity_row['id'],
+            'segment_index': segment_index,
+            'start_date_time': date_times[first],
+            'end_date_time': date_times[last],
+            'num_trackpoints': last - first + 1,
+            'gap_before_seconds': int(times[first] - times[first - 1]) if segment_index > 0 else None
+        })
+
+    return stay_point_rows, trip_segment_rows
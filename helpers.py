@@ -1,4 +1,35 @@
+from __future__ import annotations
+import sys
 import time
+import importlib.util
+
+
+def lazy_import(name: str):
+    """
+    Imports a module lazily: the module object is returned at once, and the module is only executed on first
+    attribute access. Used for heavy modules such as numpy and pandas, so that importing a module using them does not
+    slow down runs that never touch them.
+
+    :param name: The name of the module.
+    :return: The module.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+
+EARTH_RADIUS_KM = 6371.0088  # Same mean radius as the haversine package
+
 
 def time_elapsed_str(start_time):
     """
@@ -10,4 +41,13 @@ def time_elapsed_str(start_time):
     elapsed = time.time() - start_time
     minutes = round(elapsed / 60, 0)
     seconds = round(elapsed % 60, 0)
-    return f'{minutes} minutes and {seconds} seconds.'
\ No newline at end of file
+    return f'{minutes} minutes and {seconds} seconds.'
+
+
+def haversine_km(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """
+    Vectorized haversine distance, equal to haversine(..., unit='km') of the haversine package.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    d = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
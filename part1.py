@@ -1,18 +1,23 @@
+import os
 import time
 import copy
+import json
+from concurrent.futures import ProcessPoolExecutor
 from Database import Database
-from data_processing import (process_users, preprocess_activities, process_activity, process_trackpoint,
-                             read_file_to_list)
+import pandas as pd
+from data_processing import (process_users, preprocess_activities, process_activities, process_trackpoint,
+                             read_file_to_list, fingerprint_activity, compute_density_counts,
+                             compute_signature, compute_segments, process_track_blob)
 from helpers import time_elapsed_str
 
 
 class Part1:
-    def __init__(self):
+    def __init__(self, database=None):
         """
         Inits part 1
-        :param database: The Database object to operate on.
+        :param database: The Database object to operate on. Omit to connect to the primary, see Database.
         """
-        self.database = Database()
+        self.database = database or Database(role='write')
 
     def create_tables(self, debug=False):
         """
@@ -43,7 +48,8 @@ class Part1:
             'name': 'TrackPoint',
             'attributes': ['id INT UNSIGNED NOT NULL AUTO_INCREMENT', 'activity_id BIGINT UNSIGNED NOT NULL',
                            'lat DOUBLE',
-                           'lon DOUBLE', 'altitude INT', 'date_days DOUBLE', 'date_time DATETIME'],
+                           'lon DOUBLE', 'altitude INT', 'date_days DOUBLE', 'date_time DATETIME',
+                           'INDEX activity_time (activity_id, date_time, lat, lon, altitude)'],
             'primary': "id",
             'foreign': {
                 'key': 'activity_id',
@@ -51,14 +57,94 @@ class Part1:
             }
         }
 
+        density_cube = {
+            'name': 'DensityCube',
+            'attributes': ['resolution DECIMAL(6, 4) NOT NULL', 'cell_lat INT NOT NULL', 'cell_lon INT NOT NULL',
+                           'hour DATETIME NOT NULL', 'transportation_mode VARCHAR(30) NOT NULL',
+                           'user_id VARCHAR(3) NOT NULL', 'point_count INT UNSIGNED NOT NULL'],
+            'primary': 'resolution, cell_lat, cell_lon, hour, transportation_mode, user_id',
+            'foreign': {
+                'key': 'user_id',
+                'references': 'User(id)'
+            }
+        }
+
+        activity_signature = {
+            'name': 'ActivitySignature',
+            'attributes': ['activity_id BIGINT UNSIGNED NOT NULL', 'min_lat DOUBLE', 'max_lat DOUBLE', 'min_lon DOUBLE',
+                           'max_lon DOUBLE', 'start_cell_lat INT', 'start_cell_lon INT', 'end_cell_lat INT',
+                           'end_cell_lon INT', 'polyline BLOB',
+                           'INDEX start_cell (start_cell_lat, start_cell_lon)'],
+            'primary': 'activity_id',
+            'foreign': {
+                'key': 'activity_id',
+                'references': 'Activity(id)'
+            }
+        }
+
+        stay_point = {
+            'name': 'StayPoint',
+            'attributes': ['id INT UNSIGNED NOT NULL AUTO_INCREMENT', 'activity_id BIGINT UNSIGNED NOT NULL',
+                           'lat DOUBLE', 'lon DOUBLE', 'arrival_date_time DATETIME', 'departure_date_time DATETIME',
+                           'num_trackpoints INT'],
+            'primary': 'id',
+            'foreign': {
+                'key': 'activity_id',
+                'references': 'Activity(id)'
+            }
+        }
+
+        trip_segment = {
+            'name': 'TripSegment',
+            'attributes': ['activity_id BIGINT UNSIGNED NOT NULL', 'segment_index INT NOT NULL',
+                           'start_date_time DATETIME', 'end_date_time DATETIME', 'num_trackpoints INT',
+                           'gap_before_seconds INT'],
+            'primary': 'activity_id, segment_index',
+            'foreign': {
+                'key': 'activity_id',
+                'references': 'Activity(id)'
+            }
+        }
+
+        track_blob = {
+            'name': 'TrackBlob',
+            'attributes': ['activity_id BIGINT UNSIGNED NOT NULL', 'num_trackpoints INT', 'start_date_time DATETIME',
+                           'codec VARCHAR(8)', 'date_times MEDIUMBLOB', 'lat MEDIUMBLOB', 'lon MEDIUMBLOB',
+                           'altitude MEDIUMBLOB'],
+            'primary': 'activity_id',
+            'foreign': {
+                'key': 'activity_id',
+                'references': 'Activity(id)'
+            }
+        }
+
+        ingest_metadata = {
+            'name': 'IngestMetadata',
+            'attributes': ['name VARCHAR(64) NOT NULL', 'value TEXT'],
+            'primary': 'name'
+        }
+
         # Execute queries for creating tables
         self.database.create_table(user['name'], user['attributes'], user['primary'], debug=debug)
         self.database.create_table(activity['name'], activity['attributes'], activity['primary'], activity['foreign'],
                                    debug=debug)
         self.database.create_table(trackpoint['name'], trackpoint['attributes'], trackpoint['primary'],
                                    trackpoint['foreign'], debug=debug)
+        self.database.create_table(density_cube['name'], density_cube['attributes'], density_cube['primary'],
+                                   density_cube['foreign'], debug=debug)
+        self.database.create_table(activity_signature['name'], activity_signature['attributes'],
+                                   activity_signature['primary'], activity_signature['foreign'], debug=debug)
+        self.database.create_table(stay_point['name'], stay_point['attributes'], stay_point['primary'],
+                                   stay_point['foreign'], debug=debug)
+        self.database.create_table(trip_segment['name'], trip_segment['attributes'], trip_segment['primary'],
+                                   trip_segment['foreign'], debug=debug)
+        self.database.create_table(track_blob['name'], track_blob['attributes'], track_blob['primary'],
+                                   track_blob['foreign'], debug=debug)
+        self.database.create_table(ingest_metadata['name'], ingest_metadata['attributes'], ingest_metadata['primary'],
+                                   debug=debug)
 
-    def push_buffers_to_db(self, activity_buffer, trackpoint_buffer, num_activities, num_trackpoints):
+    def push_buffers_to_db(self, activity_buffer, trackpoint_buffer, num_activities, num_trackpoints,
+                           density_buffer=None, extra_buffers=None):
         """
         Push processed activities and trackpoints to the database.
 
@@ -66,71 +152,194 @@ class Part1:
         :param trackpoint_buffer: A list of buffered trackpoints.
         :param num_activities: The number of activities.
         :param num_trackpoints: The number of trackpoints.
+        :param density_buffer: A list of buffered density count DataFrames, see compute_density_counts.
+        :param extra_buffers: A dictionary of table names and lists of buffered rows for tables derived from the
+                              activities, inserted after them.
+        :return: True if the batch was committed. Every table is inserted in one transaction, so on failure nothing
+                 is committed. The buffers are emptied either way.
         """
         insert_time = time.time()
         print(f'\nInserting: {num_activities} activities and {num_trackpoints} trackpoints')
 
-        # Insert activities
-        self.database.insert_batch(table_name='Activity', batch=list(activity_buffer))
-        activity_buffer.clear()
+        # Activities first, the other tables reference them
+        batches = [('Activity', list(activity_buffer), None), ('TrackPoint', list(trackpoint_buffer), None)]
+
+        # Add density counts to the cube, merging counts of cells already in the table
+        if density_buffer:
+            density_df = pd.concat(density_buffer, ignore_index=True)
+            density_df = density_df.groupby(['resolution', 'cell_lat', 'cell_lon', 'hour', 'transportation_mode',
+                                             'user_id'], as_index=False)['point_count'].sum()
+            batches.append(('DensityCube', density_df.to_dict('records'), ['point_count']))
+
+        for table_name, buffer in (extra_buffers or {}).items():
+            batches.append((table_name, list(buffer), None))
 
-        # Insert trackpoints
-        self.database.insert_batch(table_name='TrackPoint', batch=list(trackpoint_buffer))
-        trackpoint_buffer.clear()
+        committed = self.database.insert_batches(batches)
+        for buffer in [activity_buffer, trackpoint_buffer, density_buffer or [], *(extra_buffers or {}).values()]:
+            buffer.clear()
 
         print(f'\tInsertion time: {time_elapsed_str(insert_time)}\n'
               f'\tInserts per second: {int((num_trackpoints + num_activities) / (time.time() - insert_time))}\n')
+        return committed
+
+    def new_buffers(self) -> dict:
+        """
+        Creates empty insertion buffers, filled by buffer_activity and emptied by push_buffers.
+
+        :return: A dictionary of buffers.
+        """
+        return {
+            'activity': [],
+            'trackpoint': [],
+            'density': [],
+            'extra': {'ActivitySignature': [], 'StayPoint': [], 'TripSegment': [], 'TrackBlob': []}
+        }
+
+    def buffered_rows(self, buffers: dict) -> int:
+        """
+        Counts the buffered activities and trackpoints, where trackpoints stored as blobs count one per trackpoint.
+
+        :param buffers: Buffers from new_buffers.
+        :return: The number of buffered rows.
+        """
+        num_blob_trackpoints = sum(row['num_trackpoints'] for row in buffers['extra']['TrackBlob'])
+        return len(buffers['activity']) + max(len(buffers['trackpoint']), num_blob_trackpoints)
+
+    def buffer_activity(self, activity: dict, trackpoints_df: pd.DataFrame, buffers: dict,
+                        density_resolutions=(0.1, 0.01), storage_mode='rows'):
+        """
+        Buffers a processed activity with its trackpoints and the rows derived from them.
+
+        :param activity: The processed activity data, see process_activity.
+        :param trackpoints_df: A pandas DataFrame containing the trackpoints of the activity.
+        :param buffers: Buffers from new_buffers.
+        :param density_resolutions: The grid resolutions in degrees of the DensityCube. Omit to skip building it.
+        :param storage_mode: How trackpoints are stored, see insert_data.
+        """
+        buffers['activity'].append(activity)
+        extra_buffers = buffers['extra']
+
+        if storage_mode in ('rows', 'both'):
+            for _, trackpoint_row in trackpoints_df.iterrows():
+                trackpoint = process_trackpoint(activity['id'], trackpoint_row)
+                buffers['trackpoint'].append(trackpoint)
+
+        if storage_mode in ('blob', 'both'):
+            extra_buffers['TrackBlob'].append(process_track_blob(activity['id'], trackpoints_df))
+
+        extra_buffers['ActivitySignature'].append(compute_signature(activity, trackpoints_df))
+        stay_point_rows, trip_segment_rows = compute_segments(activity, trackpoints_df)
+        extra_buffers['StayPoint'].extend(stay_point_rows)
+        extra_buffers['TripSegment'].extend(trip_segment_rows)
+
+        if density_resolutions:
+            buffers['density'].append(compute_density_counts(activity, trackpoints_df, density_resolutions))
+
+    def push_buffers(self, buffers: dict):
+        """
+        Pushes and empties the buffers, see push_buffers_to_db.
+
+        :param buffers: Buffers from new_buffers.
+        :return: True if every batch was committed.
+        """
+        return self.push_buffers_to_db(buffers['activity'], buffers['trackpoint'], len(buffers['activity']),
+                                       len(buffers['trackpoint']), buffers['density'], buffers['extra'])
+
+    def record_metadata(self, entries: dict):
+        """
+        Records entries in the IngestMetadata table, replacing entries with the same name.
+
+        :param entries: A dictionary of entry names and values. Values are stored as JSON.
+        """
+        query = "REPLACE INTO IngestMetadata (name, value) VALUES (%s, %s)"
+        self.database.cursor.executemany(query, [(name, json.dumps(value, default=str))
+                                                 for name, value in entries.items()])
+        self.database.db_connection.commit()
 
-    def insert_data(self, data_path, labeled_ids, insert_threshold=10e4):
+    def insert_data(self, data_path, labeled_ids, insert_threshold=10e4, deduplicate=True,
+                    density_resolutions=(0.1, 0.01), storage_mode='rows', subset=None, workers=None):
         """
         Insert data into the database.
 
-        :param data_path: The path to the data to be inserted.
+        Activities whose trackpoint content (start/end time, number of trackpoints and coordinates) has already been
+        seen are skipped before they are buffered, see fingerprint_activity.
+
+        :param data_path: The path to the data to be inserted: the extracted Data directory, or the zip or tar archive
+                          of the dataset, which is read without extracting it.
         :param labeled_ids: A list of labeled IDs.
         :param insert_threshold: The threshold for batch insertion.
+        :param deduplicate: A flag to skip activities with duplicate trackpoint content.
+        :param density_resolutions: The grid resolutions in degrees of the DensityCube. Omit to skip building it.
+        :param storage_mode: How trackpoints are stored: 'rows' for one TrackPoint row per trackpoint, 'blob' for one
+                             compressed TrackBlob row per activity, or 'both'.
+        :param subset: The filter of a subset ingest, see subset_settings. Omit to insert all users and activities.
+                       The filter is recorded in IngestMetadata.
+        :param workers: Number of worker processes reading and parsing the activity files, see process_activities.
+                        Omit to parse them in this process.
         """
+        if storage_mode not in ('rows', 'blob', 'both'):
+            raise ValueError(f"Unknown storage mode: {storage_mode}. Use 'rows', 'blob' or 'both'")
+
         start_time = time.time()
-        users_rows = process_users(path=data_path, labeled_ids=labeled_ids)
+        users_rows = process_users(path=data_path, labeled_ids=labeled_ids, subset=subset)
+        self.record_metadata({'data_path': data_path, 'subset': subset, 'storage_mode': storage_mode,
+                              'started_at': pd.Timestamp.now()})
         self.database.insert_batch(batch=copy.deepcopy(users_rows), table_name='User')
         num_users = len(users_rows)
         print(f"Inserted {num_users} users into User\n")
 
-        activity_buffer = []
-        trackpoint_buffer = []
+        buffers = self.new_buffers()
+        fingerprints = set()
+        num_duplicates = 0
+        executor = ProcessPoolExecutor(max_workers=workers) if workers else None
 
         for i, user_row in enumerate(users_rows):
-            activity_rows = preprocess_activities(user_row=user_row)
+            activity_rows = preprocess_activities(user_row=user_row, subset=subset)
 
-            for activity_row in activity_rows:
-                activity, trackpoints_df = process_activity(user_row, activity_row=activity_row)
+            for activity, trackpoints_df in process_activities(user_row, activity_rows, executor):
                 if not activity:  # means number of trackpoints > 2500
                     continue
 
-                activity_buffer.append(activity)
+                if deduplicate:
+                    fingerprint = fingerprint_activity(activity, trackpoints_df)
+                    if fingerprint in fingerprints:
+                        num_duplicates += 1
+                        continue
+                    fingerprints.add(fingerprint)
 
-                for _, trackpoint_row in trackpoints_df.iterrows():
-                    trackpoint = process_trackpoint(activity['id'], trackpoint_row)
-                    trackpoint_buffer.append(trackpoint)
+                self.buffer_activity(activity, trackpoints_df, buffers, density_resolutions, storage_mode)
 
-                num_activities, num_trackpoints = len(activity_buffer), len(trackpoint_buffer)
-                if num_activities + num_trackpoints > insert_threshold:
-                    self.push_buffers_to_db(activity_buffer, trackpoint_buffer, num_activities, num_trackpoints)
+                if self.buffered_rows(buffers) > insert_threshold:
+                    self.push_buffers(buffers)
 
-            print(
-                f'\rUser {user_row["id"]} processed ({i + 1} / {num_users}), Time elapsed: {time_elapsed_str(start_time)}',
-                end='')
+            print(f'\rUser {user_row["id"]} processed ({i + 1} / {num_users}), '
+                  f'Time elapsed: {time_elapsed_str(start_time)}', end='')
 
-        self.push_buffers_to_db(activity_buffer, trackpoint_buffer, len(activity_buffer), len(trackpoint_buffer))
+        if executor:
+            executor.shutdown()
+        self.push_buffers(buffers)
+        if deduplicate:
+            print(f'\nDuplicate activities skipped: {num_duplicates}')
+        self.record_metadata({'completed_at': pd.Timestamp.now()})
         print(f'\nInsertion complete - Total time: {time_elapsed_str(start_time)}')
 
-    def upload_data(self):
+    def upload_data(self, storage_mode='rows', subset=None, data_path='./dataset/dataset/Data', workers=None):
         """
         Execute the database operations.
+
+        :param storage_mode: How trackpoints are stored: 'rows', 'blob' or 'both', see insert_data.
+        :param subset: The filter of a subset ingest, e.g. subset_settings(user_sample_rate=0.05) for a 5 % slice of
+                       the users. Omit to insert the whole dataset.
+        :param data_path: The extracted Data directory, or the downloaded zip or tar archive of the dataset.
+        :param workers: Number of worker processes reading and parsing the activity files, see insert_data.
         """
-        data_path = './dataset/dataset/Data'
-        labeled_ids = read_file_to_list('./dataset/dataset/labeled_ids.txt')
-        self.database.drop(['TrackPoint', 'Activity', 'User'], debug=False)
+        labeled_ids_path = './dataset/dataset/labeled_ids.txt'
+        # Archives detect the labeled users from their labels.txt members when the list is not available
+        labeled_ids = read_file_to_list(labeled_ids_path) if os.path.exists(labeled_ids_path) else None
+        self.database.drop(['IngestMetadata', 'TrackBlob', 'TripSegment', 'StayPoint', 'ActivitySignature',
+                            'DensityCube', 'TrackPoint', 'Activity', 'User'], debug=False)
         self.create_tables(debug=False)
-        self.insert_data(data_path, labeled_ids, insert_threshold=325 * 10e2)
+        self.insert_data(data_path, labeled_ids, insert_threshold=325 * 10e2, storage_mode=storage_mode,
+                         subset=subset, workers=workers)
         self.database.close_connection()
         self.database = None
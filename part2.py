@@ -1,13 +1,17 @@
-import numpy as np
-import pandas as pd
+from __future__ import annotations
 import time
 import mysql
-from tabulate import tabulate
-from haversine import haversine, Unit
-from helpers import time_elapsed_str
-from rtree import index
+from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ThreadPoolExecutor
+from helpers import time_elapsed_str, haversine_km, lazy_import
 from Database import Database
 
+# Heavy modules are imported lazily, or inside the functions using them, to keep the startup of single tasks fast
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+SINK_PREVIEW_ROWS = 20  # Rows printed of results written to a sink, unless preview_rows is given
+
 
 def print_question(task_num: int, question_text: str):
     """
@@ -21,21 +25,45 @@ def print_question(task_num: int, question_text: str):
     print("Querying... Please wait.", end='')
 
 
-def print_result(result_df: pd.DataFrame or dict[str, list], floatfmt=".0f", filename=None):
+def print_result(result_df: pd.DataFrame or dict[str, list], floatfmt=".0f", filename=None, sink_format=None,
+                 preview_rows=None):
     """
     Tabulates and prints the result table of a query
     Args:
         result_df: result table from query as Dataframe or dictionary of lists
         floatfmt: decimal precision
         filename: name of file to write the result table to. Omit to avoid writing to file.
+        sink_format: format of the output file ('csv', 'jsonl' or 'parquet'). Omit to write the tabulated text.
+        preview_rows: number of rows to print. Omit to print the whole table, or SINK_PREVIEW_ROWS rows if
+                      sink_format is given.
 
     Returns:
 
     """
-    print('\r', end='')
-
-    display = tabulate(result_df, headers='keys', tablefmt='grid', floatfmt=floatfmt, showindex=False)
-    print(display + "\n")
+    from tabulate import tabulate
+
+    # Checked first, so that printing a dictionary does not import pandas
+    if isinstance(result_df, dict):
+        columns = list(result_df.keys())
+        rows = list(zip(*result_df.values()))
+    else:
+        columns = list(result_df.columns)
+        rows = list(result_df.itertuples(index=False, name=None))
+
+    if sink_format:
+        stream_result([rows], columns, floatfmt=floatfmt, filename=filename, sink_format=sink_format,
+                      preview_rows=SINK_PREVIEW_ROWS if preview_rows is None else preview_rows)
+        return
+
+    if preview_rows is not None and len(rows) > preview_rows:
+        # Only tabulate the whole table if it has to be written to file
+        print_preview(rows[:preview_rows], columns, floatfmt, len(rows))
+        display = tabulate(result_df, headers='keys', tablefmt='grid', floatfmt=floatfmt,
+                           showindex=False) if filename else None
+    else:
+        print('\r', end='')
+        display = tabulate(result_df, headers='keys', tablefmt='grid', floatfmt=floatfmt, showindex=False)
+        print(display + "\n")
 
     # Write to file if given
     if filename:
@@ -43,17 +71,204 @@ def print_result(result_df: pd.DataFrame or dict[str, list], floatfmt=".0f", fil
             f.write(display)
 
 
+def print_preview(rows: list, columns: list, floatfmt: str, total_rows: int):
+    """
+    Tabulates and prints the first rows of a result table.
+    Args:
+        rows: rows to print
+        columns: column names of the result table
+        floatfmt: decimal precision
+        total_rows: total number of rows in the result table
+    """
+    from tabulate import tabulate
+
+    print('\r', end='')
+    print(tabulate(rows, headers=columns, tablefmt='grid', floatfmt=floatfmt))
+    print(f'Showing {len(rows)} of {total_rows} rows\n')
+
+
+def stream_result(batches, columns: list, floatfmt=".0f", filename=None, sink_format='csv',
+                  preview_rows=SINK_PREVIEW_ROWS):
+    """
+    Writes the result table of a query to an output sink as batches of rows arrive, and prints a preview of the
+    first rows. Only the previewed rows are kept in memory.
+    Args:
+        batches: iterable of lists of row tuples
+        columns: column names of the result table
+        floatfmt: decimal precision of the preview
+        filename: name of file to write the result table to. Omit to only print the preview.
+        sink_format: format of the output file ('csv', 'jsonl' or 'parquet')
+        preview_rows: number of rows to print. Omit to print every row.
+    """
+    from sinks import open_sink
+
+    sink = open_sink(sink_format, filename, columns) if filename else None
+    preview = []
+    total_rows = 0
+    try:
+        for batch in batches:
+            if sink:
+                sink.write_rows(batch)
+            if preview_rows is None or len(preview) < preview_rows:
+                preview.extend(batch if preview_rows is None else batch[:preview_rows - len(preview)])
+            total_rows += len(batch)
+    finally:
+        if sink:
+            sink.close()
+
+    print_preview(preview, columns, floatfmt, total_rows)
+
+
+def group_trackpoints(trackpoints: list) -> dict:
+    """
+    Organizes (activity_id, lat, lon, altitude) rows by activity id.
+    Args:
+        trackpoints: rows of trackpoints
+
+    Returns:
+        dictionary of activity id and list of (lat, lon, altitude) tuples
+    """
+    trackpoints_dict = {}
+    for activity_id, lat, lon, altitude in trackpoints:
+        if activity_id not in trackpoints_dict:
+            trackpoints_dict[activity_id] = []
+        trackpoints_dict[activity_id].append((lat, lon, altitude))
+    return trackpoints_dict
+
+
+def spatially_close(tp1_list: list, tp2_list: list) -> bool:
+    """
+    Checks whether any trackpoint of one activity is within 50 meters of a trackpoint of another, using an R-tree
+    spatial index over the first activity.
+    Args:
+        tp1_list: list of (lat, lon, altitude) tuples of the first activity
+        tp2_list: list of (lat, lon, altitude) tuples of the second activity
+
+    Returns:
+        True if the activities have been close
+    """
+    from rtree import index
+    from haversine import haversine, Unit
+
+    idx = index.Index()
+    for pos, (lat, lon, _) in enumerate(tp1_list):
+        idx.insert(pos, (lat, lon, lat, lon))
+
+    for lat, lon, altitude in tp2_list:
+        nearby = list(idx.intersection((lat - 0.0005, lon - 0.0005, lat + 0.0005, lon + 0.0005)))
+        for nearby_id in nearby:
+            coord_dist = haversine(tp1_list[nearby_id][:2], (lat, lon), unit=Unit.METERS)
+            altitude_dist = np.abs(altitude - tp1_list[nearby_id][2]) * 0.3048
+            euclidean_combination = np.sqrt(coord_dist**2 + altitude_dist**2)
+
+            if euclidean_combination <= 50:
+                return True
+    return False
+
+
+def find_close_users(time_close_activities: list, trackpoints_dict: dict) -> set:
+    """
+    Finds the users of activity pairs that are close in time and have been close in space.
+    Args:
+        time_close_activities: list of (activity_id_1, activity_id_2, user_id_1, user_id_2) tuples
+        trackpoints_dict: dictionary of activity id and list of (lat, lon, altitude) tuples
+
+    Returns:
+        set of user ids
+    """
+    close_users_set = set()
+    for activity_id_1, activity_id_2, user_id_1, user_id_2 in time_close_activities:
+        if activity_id_1 in trackpoints_dict and activity_id_2 in trackpoints_dict:
+            if spatially_close(trackpoints_dict[activity_id_1], trackpoints_dict[activity_id_2]):
+                close_users_set.add(user_id_1)
+                close_users_set.add(user_id_2)
+    return close_users_set
+
+
+def trackpoint_arrays(rows: list) -> dict:
+    """
+    Converts (activity_id, date_time, id, lat, lon, altitude) rows to NumPy arrays.
+    Args:
+        rows: rows of trackpoints
+
+    Returns:
+        dictionary of column name and array
+    """
+    activity_ids, date_times, _, lats, lons, altitudes = zip(*rows)
+    return {
+        'activity_id': np.array(activity_ids, dtype=np.uint64),
+        'lat': np.array(lats, dtype=np.float64),
+        'lon': np.array(lons, dtype=np.float64),
+        'altitude': np.array([np.nan if altitude is None else altitude for altitude in altitudes], dtype=np.float64),
+        'date_time': np.array(date_times, dtype='datetime64[s]')
+    }
+
+
 class Part2:
-    def __init__(self):
-        self.database = Database()
-        self.cursor = self.database.cursor
+    def __init__(self, sink_format=None, preview_rows=None, database=None, profile=False, profile_analyze=False,
+                 workers=1, write_files=True):
+        """
+        Inits part 2
+        :param sink_format: Format of the task output files ('csv', 'jsonl' or 'parquet'). Omit to write tabulated text.
+        :param preview_rows: Number of result rows to print per task. Omit to print whole tables, or SINK_PREVIEW_ROWS
+                             rows if sink_format is given, since those results are streamed and may be large.
+        :param database: The Database object to query. Omit to connect to a replica, see Database.
+        :param profile: A flag to profile the queries of each task, see QueryProfiler. Reports are written to
+                        task_outputs/profiles and compared with the previous run. Not supported on shards.
+        :param profile_analyze: A flag to also capture EXPLAIN ANALYZE when profiling, which runs each query twice.
+        :param workers: Number of connections the window queries of tasks 9 and 11 run on in parallel, see
+                        execute_ranges. Queries on the extra connections are not profiled.
+        :param write_files: Set to False to only print the task results, without writing them to task_outputs.
+        """
+        self.database = database or Database(role='read')
+        if sink_format and preview_rows is None:
+            preview_rows = SINK_PREVIEW_ROWS
+        self.output_options = {'sink_format': sink_format, 'preview_rows': preview_rows}
+        self.write_files = write_files
+        self.profile_options = {'analyze': profile_analyze} if profile else None
+        self._profiler = None
+        self.approximation = None
+        self.workers = workers
+        self.range_workers = []  # Part2 objects with separate connections, see execute_ranges
+
+    def output_filename(self, name: str):
+        """
+        :param name: The name of a task output file.
+        :return: The name, or None if task results are not written to file.
+        """
+        return name if self.write_files else None
 
-    def execute_tasks(self, task_nums: int or range[int] or list[int]):
+    @property
+    def profiler(self):
+        """
+        The QueryProfiler if profiling, created on first use so that the connection is still opened on the first
+        query, see DbConnector.
+        """
+        if self._profiler is None and self.profile_options is not None:
+            from profiler import QueryProfiler
+            if self.cursor is None:
+                raise ValueError("Profiling needs a single connection, it is not supported on shards")
+            self._profiler = QueryProfiler(self.cursor, **self.profile_options)
+        return self._profiler
+
+    @property
+    def cursor(self):
+        # The connection is opened on the first query, see DbConnector
+        return self.database.cursor
+
+    def execute_tasks(self, task_nums: int or range[int] or list[int], exact=True, sample_rate=0.1,
+                      sample_level='activity', decimation=1, seed=0):
         """
             Executes specified tasks based on provided task numbers.
 
             :param task_nums: An integer, range, or list of integers representing the task numbers
                               to be executed.
+            :param exact: Set to False to run tasks 8, 9 and 10 approximately on a sample, with estimated error
+                          bounds. Other tasks always run exactly.
+            :param sample_rate: Fraction of activities or users sampled in approximate runs.
+            :param sample_level: 'activity' or 'user' sampling in approximate runs, see approximation_settings.
+            :param decimation: Keep every decimation-th trackpoint in approximate runs.
+            :param seed: Seed of the sample in approximate runs.
             """
         tasks = [self.task_1, self.task_2, self.task_3, self.task_4, self.task_5, self.task_6, self.task_7,
                  self.task_8, self.task_9, self.task_10, self.task_11, self.task_12]
@@ -61,9 +276,24 @@ class Part2:
         if isinstance(task_nums, int):
             task_nums = [task_nums]
 
+        self.approximation = None
+        if not exact:
+            from approximation import approximation_settings
+            self.approximation = approximation_settings(sample_rate, sample_level, decimation, seed)
+
         for num in task_nums:
+            if self.profiler:
+                self.profiler.start_task(f'task_{num}')
+
             tasks[num - 1]()
 
+            if self.profiler:
+                from profiler import diff_profiles
+                path, previous_path = self.profiler.write_report()
+                if previous_path:
+                    for regression in diff_profiles(previous_path, path):
+                        print(f'Regression since previous run: {regression}')
+
     def execute_query(self, query, params=None):
         """
         Executes a query.
@@ -75,11 +305,75 @@ class Part2:
 
         """
         try:
+            if self.database.check_replica() and self.profiler:
+                self.profiler.cursor = self.cursor
+            if self.profiler:
+                return self.profiler.execute(query, params)
             self.cursor.execute(query, params)
             return self.cursor.fetchall()
         except mysql.connector.Error as err:
             print(f"SQL-error: {err}")
 
+    def stream_query(self, query, params=None, batch_size=5000):
+        """
+        Executes a query and yields the result in batches, so that large results never have to be held in memory.
+
+        Args:
+            query: SQL query to be executed.
+            params: Parameters for query
+            batch_size: Number of rows per batch
+        Returns:
+            Generator of lists of row tuples
+        """
+        try:
+            self.database.check_replica()
+            self.cursor.execute(query, params)
+            while True:
+                batch = self.cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+        except mysql.connector.Error as err:
+            print(f"SQL-error: {err}")
+
+    def execute_ranges(self, query, ranges_per_worker=4):
+        """
+        Executes a query over disjoint ranges of activity IDs in parallel, each worker on a separate connection, and
+        concatenates the rows. The ranges hold equal numbers of activities, and several ranges per worker even out
+        activities with many trackpoints.
+
+        Args:
+            query: SQL query to be executed, taking the first and last activity ID of a range as parameters.
+            ranges_per_worker: Number of ranges per worker
+        Returns:
+            The rows of every range
+        Raises:
+            RuntimeError: if the query fails on any range, since the rows of the other ranges are only partial
+        """
+        activity_ids = [row[0] for row in self.execute_query("SELECT id FROM Activity ORDER BY id;")]
+        if not activity_ids:
+            return []
+
+        bounds = np.linspace(0, len(activity_ids), min(len(activity_ids), self.workers * ranges_per_worker) + 1)
+        bounds = bounds.astype(int)
+        ranges = [(activity_ids[start], activity_ids[end - 1]) for start, end in zip(bounds[:-1], bounds[1:])]
+        while len(self.range_workers) < self.workers:
+            self.range_workers.append(Part2(database=self.database.clone()))
+
+        def run(worker, worker_ranges):
+            worker_rows = []
+            for activity_range in worker_ranges:
+                rows = worker.execute_query(query, activity_range)
+                if rows is None:  # The SQL error is printed by execute_query
+                    raise RuntimeError(f"Query failed on activities {activity_range[0]} to {activity_range[1]}")
+                worker_rows.extend(rows)
+            return worker_rows
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(run, self.range_workers[:self.workers],
+                                   [ranges[i::self.workers] for i in range(self.workers)])
+            return [row for rows in results for row in rows]
+
     # TASK 1
     def get_user_count(self):
         """
@@ -121,7 +415,8 @@ class Part2:
                   'Number of Activities': [self.get_activity_count()],
                   'Number of TrackPoints': [self.get_tp_count()]}
 
-        print_result(result_df=result, filename=f"task_{task_num}")
+        print_result(result_df=result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 2 - OK
     def get_avg_tp(self):
@@ -196,7 +491,9 @@ class Part2:
                   'Maximum trackpoints per user': [self.get_max_tp()],
                   'Minimum trackpoints per user': [self.get_min_tp()]}
 
-        print_result(result_df=result, floatfmt=".2f", filename=f"task_{task_num}")
+        print_result(result_df=result, floatfmt=".2f", filename=self.output_filename(f"task_{task_num}"),
+                     **self.output_options)
+        return result
 
     # TASK 3 - OK
     def get_top_15_activities(self):
@@ -222,7 +519,8 @@ class Part2:
         task_num = 3
         print_question(task_num=task_num, question_text='Find the top 15 users with the highest number of activities.')
         result = pd.DataFrame(self.get_top_15_activities(), columns=["User", 'Number of Activities'])
-        print_result(result_df=result, filename=f"task_{task_num}")
+        print_result(result_df=result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 4 - OK
     def get_transportation_by_bus(self):
@@ -242,7 +540,8 @@ class Part2:
         task_num = 4
         print_question(task_num=task_num, question_text='Find all users who have taken a bus.')
         result = pd.DataFrame(self.get_transportation_by_bus(), columns=["User who have used a bus"])
-        print_result(result, filename=f"task_{task_num}")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 5 - OK
     def get_distinct_transportation_modes(self):
@@ -266,7 +565,8 @@ class Part2:
         print_question(task_num=task_num,
                        question_text='List the top 10 users by their amount of different transportation modes.')
         result = pd.DataFrame(self.get_distinct_transportation_modes(), columns=["User", "Unique transportation modes"])
-        print_result(result, filename=f"task_{task_num}")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 6 - OK
     def get_duplicate_activities(self):
@@ -296,7 +596,8 @@ class Part2:
                        question_text='Find activities that are registered multiple times.\n'
                                      'You should find the query even gives zero result.')
         result = pd.DataFrame(self.get_duplicate_activities(), columns=["User", "Activity ID", "Number of Duplicates"])
-        print_result(result, filename=f"task_{task_num}")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 7a - OK
     def get_count_multiple_day_activities(self):
@@ -312,11 +613,13 @@ class Part2:
         return self.execute_query(query)[0]
 
     # TASK 7b - OK
-    def get_list_multiple_day_activities(self):
+    def get_list_multiple_day_activities(self, stream=False):
         """
         Retrieves a list of activities that span over two consecutive days, including those with unlabeled
         transportation modes.
 
+        :param stream: If True, returns a generator of row batches instead of the full list.
+
         :return: list of tuples
             Each tuple contains:
             - user_id: The ID of the user.
@@ -331,6 +634,8 @@ class Part2:
                     FROM Activity
                     WHERE DATEDIFF(end_date_time, start_date_time) = 1
                     ORDER BY user_id, duration_in_minutes DESC;'''
+        if stream:
+            return self.stream_query(query)
         return self.execute_query(query)
 
     def task_7(self):
@@ -340,18 +645,24 @@ class Part2:
                        question_text='a) Find the number of users that have started an activity in one day and ended '
                                      'the activity the next day.')
 
-        result = {"Number of multi-day activity users": self.get_count_multiple_day_activities()}
+        count_result = {"Number of multi-day activity users": self.get_count_multiple_day_activities()}
 
-        print_result(result, filename=f"task_{task_num}a")
+        print_result(count_result, filename=self.output_filename(f"task_{task_num}a"), **self.output_options)
 
         # b
         print_question(task_num=task_num,
                        question_text='b) List the transportation mode, user id and duration for these activities.')
 
-        result = pd.DataFrame(self.get_list_multiple_day_activities(),
-                              columns=['User', 'Activity ID', 'Transportation Mode', 'Activity duration (minutes)'])
+        columns = ['User', 'Activity ID', 'Transportation Mode', 'Activity duration (minutes)']
+        if self.output_options['sink_format']:
+            stream_result(self.get_list_multiple_day_activities(stream=True), columns,
+                          filename=self.output_filename(f'task_{task_num}b'), **self.output_options)
+            return count_result, None
 
-        print_result(result, filename=f'task_{task_num}b')
+        result = pd.DataFrame(self.get_list_multiple_day_activities(), columns=columns)
+
+        print_result(result, filename=self.output_filename(f'task_{task_num}b'), **self.output_options)
+        return count_result, result
 
     # TASK 8
     def get_users_in_proximity(self):
@@ -373,6 +684,8 @@ class Part2:
         - The altitude difference is converted from feet to meters before calculating the Euclidean distance.
         - The total distance is the Euclidean combination of both.
         """
+        from approximation import sampling_condition, decimation_condition
+
         start_time = time.time()
 
         # 1. FILTER BY TIME
@@ -387,9 +700,15 @@ class Part2:
                         A1.start_date_time <= A2.end_date_time + INTERVAL 30 SECOND
                         AND A1.end_date_time >= A2.start_date_time - INTERVAL 30 SECOND
                         AND A1.user_id != A2.user_id
-                        AND A1.id < A2.id;
+                        AND A1.id < A2.id
                     '''
-        time_close_activities = self.execute_query(query_time)
+        params_time = []
+        if self.approximation:
+            for alias in ('A1', 'A2'):
+                condition, params = sampling_condition(self.approximation, f'{alias}.id', f'{alias}.user_id')
+                query_time += f' AND {condition}'
+                params_time.extend(params)
+        time_close_activities = self.execute_query(query_time, tuple(params_time))
 
         # 2. FETCH ALL TRACKPOINTS
         unique_activity_ids = set()
@@ -398,40 +717,17 @@ class Part2:
             unique_activity_ids.add(activity[1])
 
         placeholders = ', '.join(['%s'] * len(unique_activity_ids))
-        query_trackpoints = f"SELECT activity_id, lat, lon, altitude FROM TrackPoint WHERE activity_id IN ({placeholders});"
-        all_trackpoints = self.execute_query(query_trackpoints, tuple(unique_activity_ids))
-
-        # Organize trackpoints by activity id
-        trackpoints_dict = {}
-        for activity_id, lat, lon, altitude in all_trackpoints:
-            if activity_id not in trackpoints_dict:
-                trackpoints_dict[activity_id] = []
-            trackpoints_dict[activity_id].append((lat, lon, altitude))
-
-        # 3. SPATIAL FILTERING USING R-TREE
-        def spatially_close(tp1_list, tp2_list):
-            idx = index.Index()
-            for pos, (lat, lon, _) in enumerate(tp1_list):
-                idx.insert(pos, (lat, lon, lat, lon))
-
-            for lat, lon, altitude in tp2_list:
-                nearby = list(idx.intersection((lat - 0.0005, lon - 0.0005, lat + 0.0005, lon + 0.0005)))
-                for nearby_id in nearby:
-                    coord_dist = haversine(tp1_list[nearby_id][:2], (lat, lon), unit=Unit.METERS)
-                    altitude_dist = np.abs(altitude - tp1_list[nearby_id][2]) * 0.3048
-                    euclidean_combination = np.sqrt(coord_dist**2 + altitude_dist**2)
-
-                    if euclidean_combination <= 50:
-                        return True
-            return False
-
-        # 4. FIND USERS IN PROXIMITY
-        close_users_set = set()
-        for activity_id_1, activity_id_2, user_id_1, user_id_2 in time_close_activities:
-            if activity_id_1 in trackpoints_dict and activity_id_2 in trackpoints_dict:
-                if spatially_close(trackpoints_dict[activity_id_1], trackpoints_dict[activity_id_2]):
-                    close_users_set.add(user_id_1)
-                    close_users_set.add(user_id_2)
+        query_trackpoints = (f"SELECT activity_id, lat, lon, altitude FROM TrackPoint "
+                             f"WHERE activity_id IN ({placeholders})")
+        params_trackpoints = list(unique_activity_ids)
+        if self.approximation and self.approximation['decimation'] > 1:
+            condition, params = decimation_condition(self.approximation)
+            query_trackpoints += f' AND {condition}'
+            params_trackpoints.extend(params)
+        all_trackpoints = self.execute_query(query_trackpoints, tuple(params_trackpoints))
+
+        # 3. SPATIAL FILTERING USING R-TREE AND 4. FIND USERS IN PROXIMITY
+        close_users_set = find_close_users(time_close_activities, group_trackpoints(all_trackpoints))
 
         print(f'\rFinished. Time elapsed: {time_elapsed_str(start_time)}')
         return len(close_users_set)
@@ -442,8 +738,17 @@ class Part2:
                        question_text='Find the number of users which have been close to each other in time and space.\n'
                                      'Close is defined as the same space (50 meters) and for the same half minute (30 '
                                      'seconds)')
+        if self.approximation:
+            # Sampling and decimation can only miss contacts, so the sampled count is a lower bound. There is no
+            # estimate of the contacts missed, so no upper bound is reported
+            result = {"Users which have been close to another user in the sample": [self.get_users_in_proximity()],
+                      "Bound": ["lower bound only, the sample can only miss contacts"]}
+            print_result(result, filename=self.output_filename(f"task_{task_num}_approx"), **self.output_options)
+            return result
+
         result = {"Users which have been close to another user": [self.get_users_in_proximity()]}
-        print_result(result, filename=f"task_{task_num}")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 9
     def get_top_altitude_gains(self):
@@ -459,6 +764,9 @@ class Part2:
             :return: A list of the top 15 users with their respective total altitude gains in meters, ordered in
                      descending order of altitude gained.
             """
+        if self.workers > 1:
+            return self.get_top_altitude_gains_parallel()
+
         query = '''
         WITH CurrentAndPreviousAltitudes AS (
             SELECT Activity.user_id,
@@ -480,14 +788,100 @@ class Part2:
 
         return self.execute_query(query)
 
+    def get_top_altitude_gains_parallel(self):
+        """
+        Computes get_top_altitude_gains with the window query split over activity ID ranges, see execute_ranges.
+        The feet gained are summed exactly per range and user, and rounded like MySQL rounds the DECIMAL product,
+        half away from zero, so the result is identical to the single query.
+        """
+        query = '''
+        WITH CurrentAndPreviousAltitudes AS (
+            SELECT Activity.user_id,
+                   TrackPoint.altitude AS current_altitude,
+                   LAG(TrackPoint.altitude) OVER(
+                       PARTITION BY TrackPoint.activity_id ORDER BY TrackPoint.date_time) AS previous_altitude
+            FROM TrackPoint
+            JOIN Activity ON TrackPoint.activity_id = Activity.id
+            WHERE TrackPoint.altitude IS NOT NULL AND TrackPoint.activity_id BETWEEN %s AND %s)
+
+        SELECT user_id, SUM(IF(current_altitude > previous_altitude, current_altitude - previous_altitude, 0))
+        FROM CurrentAndPreviousAltitudes
+        WHERE previous_altitude IS NOT NULL
+        GROUP BY user_id;'''
+
+        feet_gained = {}
+        for user_id, feet in self.execute_ranges(query):
+            feet_gained[user_id] = feet_gained.get(user_id, 0) + Decimal(feet)
+
+        meters_gained = [(user_id, (feet * Decimal('0.3048')).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+                         for user_id, feet in feet_gained.items()]
+        return sorted(meters_gained, key=lambda row: row[1], reverse=True)[:15]
+
+    def estimate_top_altitude_gains(self):
+        """
+        Estimates the top 15 users who have gained the most altitude meters from a sample of activities or users,
+        see get_top_altitude_gains and estimate_totals.
+
+        :return: pd.DataFrame
+            The top 15 users by estimated altitude gain in meters, with a 95 % confidence interval.
+        """
+        from approximation import estimate_totals
+
+        contributions = self.get_altitude_gain_contributions(self.approximation)
+        totals = estimate_totals(contributions, ['User'], 'meters_gained', self.approximation)
+        totals = totals.sort_values('estimate', ascending=False).head(15)
+        return totals.rename(columns={'estimate': 'Altitude Gained (meters, estimate)', 'ci_low': '95 % CI low',
+                                      'ci_high': '95 % CI high', 'bound': 'Bound'})
+
+    def get_altitude_gain_contributions(self, approximation: dict):
+        """
+        Retrieves the altitude gained in each sampled activity, see estimate_top_altitude_gains.
+
+        :param approximation: Settings from approximation_settings.
+        :return: pd.DataFrame
+            One row per sampled activity with User, activity_id and meters_gained.
+        """
+        from approximation import sampling_condition, decimation_condition
+
+        sample, params = sampling_condition(approximation)
+        decimate, decimate_params = decimation_condition(approximation)
+        query = f'''
+        WITH CurrentAndPreviousAltitudes AS (
+            SELECT Activity.user_id,
+                   TrackPoint.activity_id,
+                   TrackPoint.altitude AS current_altitude,
+                   LAG(TrackPoint.altitude) OVER(
+                       PARTITION BY TrackPoint.activity_id ORDER BY TrackPoint.date_time) AS previous_altitude
+            FROM TrackPoint
+            JOIN Activity ON TrackPoint.activity_id = Activity.id
+            WHERE TrackPoint.altitude IS NOT NULL AND {sample} AND {decimate})
+
+        SELECT user_id, activity_id,
+            SUM(IF(current_altitude > previous_altitude, current_altitude - previous_altitude, 0)) * 0.3048
+                AS meters_gained
+        FROM CurrentAndPreviousAltitudes
+        WHERE previous_altitude IS NOT NULL
+        GROUP BY user_id, activity_id;'''
+
+        contributions = pd.DataFrame(self.execute_query(query, (*params, *decimate_params)),
+                                     columns=['User', 'activity_id', 'meters_gained'])
+        contributions['meters_gained'] = contributions['meters_gained'].astype(float)
+        return contributions
+
     def task_9(self):
         task_num = 9
         print_question(task_num=task_num,
                        question_text='Find the top 15 users who have gained the most altitude meters.\nOutput should '
                                      'be a table with (id, total meters gained per user). Remember that some '
                                      'altitude-values are invalid')
+        if self.approximation:
+            result = self.estimate_top_altitude_gains()
+            print_result(result, filename=self.output_filename(f"task_{task_num}_approx"), **self.output_options)
+            return result
+
         result = pd.DataFrame(self.get_top_altitude_gains(), columns=['User', 'Altitude Gained (meters)'])
-        print_result(result, filename=f"task_{task_num}")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 10
     def get_longest_distance_per_transportation(self):
@@ -504,6 +898,8 @@ class Part2:
                      kilometers. Each entry in the list is in the format: [user_id, transportation_mode, distance]. The
                      results are ordered by transportation mode.
             """
+        from haversine import haversine
+
         query = '''
                 SELECT Activity.user_id, Activity.transportation_mode, TrackPoint.lat, TrackPoint.lon, 
                        DATE(Activity.start_date_time) AS travel_day
@@ -545,21 +941,89 @@ class Part2:
 
         return output
 
+    def estimate_longest_distance_per_transportation(self):
+        """
+        Estimates the users who have traveled the longest total distance for each transportation mode from a sample
+        of activities or users, see get_longest_distance_per_transportation and estimate_totals. The distance
+        between two consecutive trackpoints is attributed to the activity of the second one.
+
+        :return: pd.DataFrame
+            For each transportation mode, the user with the largest estimated distance in kilometers, with a 95 %
+            confidence interval.
+        """
+        from approximation import estimate_totals
+
+        contributions = self.get_distance_contributions(self.approximation)
+        totals = estimate_totals(contributions, ['user_id', 'transportation_mode'], 'distance', self.approximation)
+        best = totals.loc[totals.groupby('transportation_mode')['estimate'].idxmax()]
+        return best.rename(columns={'user_id': 'User ID', 'transportation_mode': 'Transportation Mode',
+                                    'estimate': 'Distance in km (estimate)', 'ci_low': '95 % CI low',
+                                    'ci_high': '95 % CI high', 'bound': 'Bound'})
+
+    def get_distance_contributions(self, approximation: dict):
+        """
+        Retrieves the distance traveled in each sampled activity, see estimate_longest_distance_per_transportation.
+
+        :param approximation: Settings from approximation_settings.
+        :return: pd.DataFrame
+            One row per sampled activity with user_id, transportation_mode ('None' if unlabeled), activity_id and
+            distance in kilometers.
+        """
+        from approximation import sampling_condition, decimation_condition
+
+        sample, params = sampling_condition(approximation)
+        decimate, decimate_params = decimation_condition(approximation)
+        query = f'''
+                SELECT Activity.user_id, Activity.transportation_mode, Activity.id, TrackPoint.lat, TrackPoint.lon,
+                       DATE(Activity.start_date_time) AS travel_day
+                FROM Activity
+                JOIN TrackPoint ON Activity.id = TrackPoint.activity_id
+                WHERE TIMESTAMPDIFF(SECOND , Activity.start_date_time, Activity.end_date_time) <= 86400
+                  AND {sample} AND {decimate}
+                ORDER BY Activity.user_id, Activity.transportation_mode, TrackPoint.date_time;
+            '''
+        data = pd.DataFrame(self.execute_query(query, (*params, *decimate_params)),
+                            columns=['user_id', 'transportation_mode', 'activity_id', 'lat', 'lon', 'travel_day'])
+        data['transportation_mode'] = data['transportation_mode'].fillna('None')
+
+        previous, current = data.iloc[:-1].reset_index(drop=True), data.iloc[1:].reset_index(drop=True)
+        consecutive = ((previous['user_id'] == current['user_id'])
+                       & (previous['transportation_mode'] == current['transportation_mode'])
+                       & (previous['travel_day'] == current['travel_day']))
+        contributions = current.loc[consecutive, ['user_id', 'transportation_mode', 'activity_id']].copy()
+        contributions['distance'] = haversine_km(previous['lat'][consecutive].to_numpy(dtype=float),
+                                                 previous['lon'][consecutive].to_numpy(dtype=float),
+                                                 current['lat'][consecutive].to_numpy(dtype=float),
+                                                 current['lon'][consecutive].to_numpy(dtype=float))
+        return contributions.groupby(['user_id', 'transportation_mode', 'activity_id'],
+                                     as_index=False)['distance'].sum()
+
     def task_10(self):
         task_num = 10
         print_question(task_num=task_num,
                        question_text="Find the users that have traveled the longest total distance in one "
                                      "day for each transportation mode.")
+        if self.approximation:
+            result = self.estimate_longest_distance_per_transportation()
+            print_result(result, filename=self.output_filename(f"task_{task_num}_approx"),
+                         floatfmt=".2f", **self.output_options)
+            return result
+
         result = pd.DataFrame(self.get_longest_distance_per_transportation(),
                               columns=['User ID', 'Transportation Mode', 'Distance in km'])
-        print_result(result, filename=f"task_{task_num}", floatfmt=".2f")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), floatfmt=".2f", **self.output_options)
+        return result
 
     # TASK 11
-    def get_invalid_activities(self):
+    def get_invalid_activities(self, precomputed=False):
         """
         Identifies users and the count of their activities that have trackpoints with time differences exceeding
         5 minutes.
 
+        With precomputed, the activities are read from TripSegment instead: activities split into more than one trip
+        segment at gaps of 5 minutes or more during insertion are invalid, which avoids the window query over
+        TrackPoint.
+
         The function works as follows:
         1. Calculates the time difference between consecutive trackpoints for each activity.
         2. Identifies activities where any time difference between trackpoints exceeds 5 minutes.
@@ -574,6 +1038,19 @@ class Part2:
         - An activity is considered invalid if there's a gap of 5 minutes or more between any two consecutive
             trackpoints.
         """
+        if precomputed:
+            query = """
+            SELECT Activity.user_id, COUNT(DISTINCT TripSegment.activity_id) AS invalid_activity_count
+            FROM TripSegment
+            JOIN Activity ON TripSegment.activity_id = Activity.id
+            WHERE TripSegment.segment_index > 0
+            GROUP BY Activity.user_id
+            ORDER BY Activity.user_id;"""
+            return self.execute_query(query)
+
+        if self.workers > 1:
+            return self.get_invalid_activities_parallel()
+
         query = """
         WITH TrackpointDifferences AS (
         SELECT TrackPoint.activity_id,
@@ -599,14 +1076,47 @@ class Part2:
 
         return self.execute_query(query)
 
-    def task_11(self):
+    def get_invalid_activities_parallel(self):
+        """
+        Computes get_invalid_activities with the window query split over activity ID ranges, see execute_ranges.
+        An activity lies in exactly one range, so the per-user counts of the ranges add up to the single query.
+        """
+        query = """
+        WITH TrackpointDifferences AS (
+        SELECT TrackPoint.activity_id,
+               (TIMESTAMPDIFF(SECOND,
+                    LAG(TrackPoint.date_time)
+                    OVER(PARTITION BY TrackPoint.activity_id ORDER BY TrackPoint.date_time),
+                    TrackPoint.date_time) / 60.0) AS time_difference
+        FROM TrackPoint
+        WHERE TrackPoint.activity_id BETWEEN %s AND %s),
+
+        InvalidActivity AS (
+            SELECT activity_id
+            FROM TrackpointDifferences
+            WHERE time_difference >= 5.0
+            GROUP BY activity_id
+        )
+
+        SELECT Activity.user_id, COUNT(DISTINCT InvalidActivity.activity_id) AS invalid_activity_count
+        FROM InvalidActivity
+        JOIN Activity ON InvalidActivity.activity_id = Activity.id
+        GROUP BY Activity.user_id;"""
+
+        invalid_counts = {}
+        for user_id, count in self.execute_ranges(query):
+            invalid_counts[user_id] = invalid_counts.get(user_id, 0) + count
+        return sorted(invalid_counts.items())
+
+    def task_11(self, precomputed=False):
         task_num = 11
         print_question(task_num=task_num,
                        question_text="Find all users who have invalid activities, and the number of invalid activities "
                                      "per user.\nAn invalid activity is defined as an activity with consecutive "
                                      "trackpoints where the timestamps\ndeviate with at least 5 minutes.")
-        result = pd.DataFrame(self.get_invalid_activities(), columns=['User ID', 'Invalid Activities'])
-        print_result(result, filename=f"task_{task_num}")
+        result = pd.DataFrame(self.get_invalid_activities(precomputed), columns=['User ID', 'Invalid Activities'])
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
 
     # TASK 12
     def get_most_used_transportations(self):
@@ -658,4 +1168,278 @@ class Part2:
                                      "transportation_mode.")
         result = pd.DataFrame(self.get_most_used_transportations(),
                               columns=['User ID', 'Most Used Transportation Mode', 'Amount'])
-        print_result(result, filename=f"task_{task_num}")
+        print_result(result, filename=self.output_filename(f"task_{task_num}"), **self.output_options)
+        return result
+
+    # DENSITY CUBE
+    def get_trackpoint_density(self, resolution=0.01, lat_range=None, lon_range=None, time_range=None,
+                               transportation_mode=None, user_id=None, group_by=('cell_lat', 'cell_lon')):
+        """
+        Retrieves trackpoint counts from the pre-aggregated DensityCube, built during insertion in part 1.
+
+        :param resolution: Grid resolution in degrees. Must be one of the resolutions the cube was built with.
+        :param lat_range: Tuple (min, max) of latitudes to include. Omit to include all.
+        :param lon_range: Tuple (min, max) of longitudes to include. Omit to include all.
+        :param time_range: Tuple (start, end) of date times to include, end exclusive. Omit to include all.
+        :param transportation_mode: Transportation mode to include, '' for unlabeled activities. Omit to include all.
+        :param user_id: User ID to include. Omit to include all.
+        :param group_by: Cube dimensions to group the counts by, any of 'cell_lat', 'cell_lon', 'hour',
+                         'transportation_mode' and 'user_id'.
+        :return: pd.DataFrame
+            One row per group with the dimensions in group_by and the number of trackpoints in point_count.
+            Cell coordinates are given as the south-west corner of the cell in degrees.
+        """
+        dimensions = ['cell_lat', 'cell_lon', 'hour', 'transportation_mode', 'user_id']
+        if any(dimension not in dimensions for dimension in group_by):
+            raise ValueError(f"Unknown dimension in {group_by}. Use any of {dimensions}")
+
+        conditions = ['resolution = %s']
+        params = [resolution]
+        if lat_range:
+            conditions.append('cell_lat BETWEEN FLOOR(%s / resolution) AND FLOOR(%s / resolution)')
+            params.extend(lat_range)
+        if lon_range:
+            conditions.append('cell_lon BETWEEN FLOOR(%s / resolution) AND FLOOR(%s / resolution)')
+            params.extend(lon_range)
+        if time_range:
+            conditions.append('hour >= %s AND hour < %s')
+            params.extend(time_range)
+        if transportation_mode is not None:
+            conditions.append('transportation_mode = %s')
+            params.append(transportation_mode)
+        if user_id is not None:
+            conditions.append('user_id = %s')
+            params.append(user_id)
+
+        columns = ', '.join(group_by)
+        query = f'''SELECT {columns + ', ' if group_by else ''}SUM(point_count) AS point_count
+                    FROM DensityCube
+                    WHERE {' AND '.join(conditions)}
+                    {'GROUP BY ' + columns if group_by else ''};'''
+
+        result = pd.DataFrame(self.execute_query(query, tuple(params)), columns=[*group_by, 'point_count'])
+        for cell in ('cell_lat', 'cell_lon'):
+            if cell in result:
+                result[cell] = result[cell] * resolution
+        return result
+
+    # SIMILARITY SEARCH
+    def get_similar_activities(self, activity_id: int, k=10, max_distance=2000, cell_size=0.01, batch_size=256):
+        """
+        Finds the k activities with trajectories most similar to the given activity, using the signatures stored in
+        ActivitySignature during insertion in part 1.
+
+        The function works as follows:\n
+        1. Fetches the candidates whose start and end cells lie within max_distance of the start and end of the
+           activity, using the start cell index.\n
+        2. Discards candidates whose lower bound (the largest of the start and end point distances) exceeds
+           max_distance, and sorts the rest by it.\n
+        3. Computes the discrete Fréchet distance between the resampled polylines in vectorized batches, stopping
+           when the lower bound of the next batch exceeds the k-th best distance found.
+
+        :param activity_id: ID of the activity to compare with.
+        :param k: Number of similar activities to return.
+        :param max_distance: Largest Fréchet distance in meters of activities to return.
+        :param cell_size: Size of the start and end cells in degrees, as used by compute_signature.
+        :param batch_size: Number of candidates per vectorized distance computation.
+        :return: pd.DataFrame
+            The similar activities with activity ID, user ID and Fréchet distance in meters, ordered by distance.
+        """
+        return self.get_similar_signatures(self.get_activity_signature(activity_id), activity_id, k, max_distance,
+                                           cell_size, batch_size)
+
+    def get_activity_signature(self, activity_id: int):
+        """
+        Retrieves the signature of an activity from ActivitySignature.
+
+        :param activity_id: ID of the activity.
+        :return: A tuple (start_cell_lat, start_cell_lon, end_cell_lat, end_cell_lon, polyline), or None if the
+                 activity has no signature.
+        """
+        query = '''SELECT start_cell_lat, start_cell_lon, end_cell_lat, end_cell_lon, polyline
+                   FROM ActivitySignature
+                   WHERE activity_id = %s;'''
+        signature = self.execute_query(query, (activity_id,))
+        return tuple(signature[0]) if signature else None
+
+    def get_similar_signatures(self, signature, activity_id: int, k=10, max_distance=2000, cell_size=0.01,
+                               batch_size=256):
+        """
+        Finds the k activities most similar to a signature, see get_similar_activities.
+
+        :param signature: The signature to compare with, see get_activity_signature. None gives an empty result.
+        :param activity_id: ID of the activity of the signature, which is excluded from the result.
+        :return: pd.DataFrame
+            The similar activities with activity ID, user ID and Fréchet distance in meters, ordered by distance.
+        """
+        from similarity import decode_polylines, endpoint_lower_bounds, discrete_frechet
+
+        columns = ['Activity ID', 'User ID', 'Distance (meters)']
+        if signature is None:
+            return pd.DataFrame([], columns=columns)
+        start_cell_lat, start_cell_lon, end_cell_lat, end_cell_lon, polyline = signature
+        query_polyline = decode_polylines([polyline])[0]
+
+        # 1. CANDIDATES FROM START CELL INDEX
+        lat_cells = int(np.ceil(max_distance / (111320 * cell_size)))
+        lon_cells = int(np.ceil(lat_cells / max(np.cos(np.radians(query_polyline[0, 0])), 0.01)))
+        query = '''SELECT ActivitySignature.activity_id, Activity.user_id, ActivitySignature.polyline
+                   FROM ActivitySignature
+                   JOIN Activity ON ActivitySignature.activity_id = Activity.id
+                   WHERE ActivitySignature.start_cell_lat BETWEEN %s AND %s
+                     AND ActivitySignature.start_cell_lon BETWEEN %s AND %s
+                     AND ActivitySignature.end_cell_lat BETWEEN %s AND %s
+                     AND ActivitySignature.end_cell_lon BETWEEN %s AND %s
+                     AND ActivitySignature.activity_id != %s;'''
+        candidates = self.execute_query(query, (start_cell_lat - lat_cells, start_cell_lat + lat_cells,
+                                                start_cell_lon - lon_cells, start_cell_lon + lon_cells,
+                                                end_cell_lat - lat_cells, end_cell_lat + lat_cells,
+                                                end_cell_lon - lon_cells, end_cell_lon + lon_cells, activity_id))
+        if not candidates:
+            return pd.DataFrame([], columns=columns)
+
+        candidate_ids = np.array([candidate[0] for candidate in candidates])
+        candidate_users = np.array([candidate[1] for candidate in candidates])
+        candidate_polylines = decode_polylines([candidate[2] for candidate in candidates])
+
+        # 2. LOWER BOUND PRUNING
+        lower_bounds = endpoint_lower_bounds(query_polyline, candidate_polylines)
+        order = np.argsort(lower_bounds)
+        order = order[lower_bounds[order] <= max_distance]
+
+        # 3. EXACT DISTANCES ON SURVIVORS
+        best_ids, best_distances = np.array([], dtype=int), np.array([])
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            if len(best_distances) == k and lower_bounds[batch[0]] > best_distances[-1]:
+                break
+
+            distances = discrete_frechet(query_polyline, candidate_polylines[batch])
+            keep = distances <= max_distance
+            best_ids = np.concatenate((best_ids, batch[keep]))
+            best_distances = np.concatenate((best_distances, distances[keep]))
+            top = np.argsort(best_distances, kind='stable')[:k]
+            best_ids, best_distances = best_ids[top], best_distances[top]
+
+        return pd.DataFrame({columns[0]: candidate_ids[best_ids], columns[1]: candidate_users[best_ids],
+                             columns[2]: best_distances})
+
+    # STAY POINTS
+    def get_stay_points(self, user_id=None, min_duration=None):
+        """
+        Retrieves the stay points detected during insertion in part 1, where a user stayed within 200 meters for at
+        least 20 minutes.
+
+        :param user_id: User ID to retrieve stay points for. Omit to retrieve for all users.
+        :param min_duration: Shortest stay in minutes to retrieve. Omit to retrieve all.
+        :return: pd.DataFrame
+            The stay points with user ID, activity ID, position, arrival and departure time and duration in minutes,
+            ordered by user and arrival time.
+        """
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append('Activity.user_id = %s')
+            params.append(user_id)
+        if min_duration is not None:
+            conditions.append('TIMESTAMPDIFF(MINUTE, StayPoint.arrival_date_time, StayPoint.departure_date_time) >= %s')
+            params.append(min_duration)
+
+        query = f'''SELECT Activity.user_id, StayPoint.activity_id, StayPoint.lat, StayPoint.lon,
+                           StayPoint.arrival_date_time, StayPoint.departure_date_time,
+                           TIMESTAMPDIFF(MINUTE, StayPoint.arrival_date_time, StayPoint.departure_date_time)
+                    FROM StayPoint
+                    JOIN Activity ON StayPoint.activity_id = Activity.id
+                    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                    ORDER BY Activity.user_id, StayPoint.arrival_date_time;'''
+
+        return pd.DataFrame(self.execute_query(query, tuple(params)),
+                            columns=['User ID', 'Activity ID', 'Latitude', 'Longitude', 'Arrival', 'Departure',
+                                     'Duration (minutes)'])
+
+    # TRACK BLOBS
+    def get_trajectories(self, activity_ids: list) -> dict:
+        """
+        Retrieves whole trajectories from the compressed TrackBlob table, one row per activity, as an alternative to
+        fetching every TrackPoint row. Requires insertion with storage_mode 'blob' or 'both' in part 1.
+
+        :param activity_ids: IDs of the activities to retrieve.
+        :return: dict
+            Activity ID mapped to a dictionary of NumPy arrays, see Database.decode_trajectory.
+        """
+        if not activity_ids:
+            return {}
+
+        placeholders = ', '.join(['%s'] * len(activity_ids))
+        query = f'''SELECT activity_id, start_date_time, codec, date_times, lat, lon, altitude
+                    FROM TrackBlob
+                    WHERE activity_id IN ({placeholders});'''
+        return {row[0]: Database.decode_trajectory(*row[1:]) for row in self.execute_query(query, tuple(activity_ids))}
+
+    # TRAJECTORY WINDOWS
+    def iter_trackpoints(self, user_id=None, activity_ids=None, time_range=None, page_size=10000):
+        """
+        Iterates over trackpoints page by page, ordered by activity and time, using keyset pagination on
+        (activity_id, date_time, id) over the covering index activity_time of TrackPoint. Each page continues after
+        the last row of the previous one instead of using an OFFSET, so every page costs the same however deep it
+        is, and only one page is held in memory at a time.
+
+        :param user_id: User ID to retrieve trackpoints for. Omit to retrieve for all users.
+        :param activity_ids: IDs of the activities to retrieve trackpoints for. Omit to retrieve for all activities.
+        :param time_range: Tuple (start, end) of date times to include, end exclusive. Omit to include all.
+        :param page_size: Number of trackpoints per page.
+        :return: Generator of dict
+            One dictionary of NumPy arrays per page: activity_id, lat, lon, altitude (NaN where invalid) and
+            date_time (datetime64[s]).
+        """
+        # Only the IDs of the matching activities are fetched up front
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append('user_id = %s')
+            params.append(user_id)
+        if activity_ids is not None:
+            if not activity_ids:
+                return
+            conditions.append(f"id IN ({', '.join(['%s'] * len(activity_ids))})")
+            params.extend(activity_ids)
+        if time_range:
+            conditions.append('start_date_time < %s AND end_date_time >= %s')
+            params.extend([time_range[1], time_range[0]])
+        query = f'''SELECT id FROM Activity
+                    {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                    ORDER BY id;'''
+        remaining = [row[0] for row in self.execute_query(query, tuple(params))]
+
+        time_condition = 'AND date_time >= %s AND date_time < %s' if time_range else ''
+        window_size = max(1, page_size // 100)  # Activities searched per query
+        last_key = None
+        page = []
+        while remaining:
+            window = remaining[:window_size]
+            placeholders = ', '.join(['%s'] * len(window))
+            if last_key:
+                key_condition = '''AND (activity_id > %s
+                                        OR (activity_id = %s AND (date_time > %s OR (date_time = %s AND id > %s))))'''
+                key_params = (last_key[0], last_key[0], last_key[1], last_key[1], last_key[2])
+            else:
+                key_condition, key_params = '', ()
+            query = f'''SELECT activity_id, date_time, id, lat, lon, altitude
+                        FROM TrackPoint FORCE INDEX (activity_time)
+                        WHERE activity_id IN ({placeholders}) {time_condition} {key_condition}
+                        ORDER BY activity_id, date_time, id
+                        LIMIT %s;'''
+            rows = self.execute_query(query, (*window, *(time_range or ()), *key_params, page_size - len(page)))
+            page.extend(rows)
+
+            if len(page) == page_size:
+                last_key = page[-1][:3]
+                # Activities before the last one returned are complete
+                remaining = remaining[remaining.index(last_key[0]):]
+                yield trackpoint_arrays(page)
+                page = []
+            else:
+                # Every activity in the window is complete
+                remaining = remaining[len(window):]
+                last_key = None
+
+        if page:
+            yield trackpoint_arrays(page)
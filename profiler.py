@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import hashlib
+
+# Session status counters recorded for every statement
+STATUS_COUNTERS = ['Handler_read_first', 'Handler_read_key', 'Handler_read_last', 'Handler_read_next',
+                   'Handler_read_prev', 'Handler_read_rnd', 'Handler_read_rnd_next', 'Created_tmp_tables',
+                   'Created_tmp_disk_tables', 'Sort_merge_passes', 'Sort_range', 'Sort_rows', 'Sort_scan',
+                   'Select_full_join', 'Select_range', 'Select_scan']
+
+# Counters where any increase from zero is reported as a regression
+REGRESSION_COUNTERS = ['Created_tmp_disk_tables', 'Sort_merge_passes', 'Select_full_join']
+
+
+class QueryProfiler:
+    def __init__(self, cursor, explain=True, analyze=False, output_dir='task_outputs/profiles'):
+        """
+        Records timings, row counts, query plans and session status deltas of the statements executed for each task.
+
+        :param cursor: The cursor the statements are executed on. Status counters are read on the same session.
+        :param explain: A flag to capture the EXPLAIN FORMAT=JSON plan of each statement.
+        :param analyze: A flag to also capture EXPLAIN ANALYZE, which executes each statement a second time.
+        :param output_dir: The directory to write the profile reports to.
+        """
+        self.cursor = cursor
+        self.explain = explain
+        self.analyze = analyze
+        self.output_dir = output_dir
+        self.task_name = None
+        self.statements = []
+
+        # Reading the status counters may itself change some of them, which is subtracted from every delta
+        first = self.read_status()
+        self.status_overhead = diff_status(first, self.read_status())
+
+    def read_status(self) -> dict:
+        """
+        Reads the session status counters.
+
+        :return: A dictionary of counter names and values.
+        """
+        placeholders = ', '.join(['%s'] * len(STATUS_COUNTERS))
+        self.cursor.execute(f"SHOW SESSION STATUS WHERE Variable_name IN ({placeholders});", tuple(STATUS_COUNTERS))
+        return {name: int(value) for name, value in self.cursor.fetchall()}
+
+    def start_task(self, task_name: str):
+        """
+        Starts recording the statements of a task.
+
+        :param task_name: The name of the task, used as file name of the report.
+        """
+        self.task_name = task_name
+        self.statements = []
+
+    def execute(self, query, params=None) -> list:
+        """
+        Executes and profiles a statement.
+
+        :param query: SQL query to be executed.
+        :param params: Parameters for query.
+        :return: The rows of the result.
+        """
+        status_before = self.read_status()
+
+        start_time = time.perf_counter()
+        self.cursor.execute(query, params)
+        execute_time = time.perf_counter() - start_time
+        rows = self.cursor.fetchall()
+        fetch_time = time.perf_counter() - start_time - execute_time
+
+        status_delta = diff_status(status_before, self.read_status())
+        status_delta = {name: value - self.status_overhead.get(name, 0) for name, value in status_delta.items()}
+
+        statement = {
+            'query': ' '.join(query.split()),
+            'query_hash': hashlib.sha1(' '.join(query.split()).encode()).hexdigest()[:12],
+            'wall_time': execute_time + fetch_time,
+            'execute_time': execute_time,
+            'fetch_time': fetch_time,
+            'rows': len(rows),
+            'rows_examined': sum(value for name, value in status_delta.items() if name.startswith('Handler_read')),
+            'status': status_delta
+        }
+        if self.explain:
+            self.cursor.execute("EXPLAIN FORMAT=JSON " + query, params)
+            statement['plan'] = json.loads(self.cursor.fetchone()[0])
+        if self.analyze:
+            self.cursor.execute("EXPLAIN ANALYZE " + query, params)
+            statement['analyze'] = self.cursor.fetchone()[0]
+
+        self.statements.append(statement)
+        return rows
+
+    def write_report(self) -> tuple:
+        """
+        Writes the profile of the current task to a JSON file and prints a summary. The report of the previous run is
+        kept next to it with the suffix .previous.json.
+
+        :return: A tuple containing the path of the report and the path of the previous report, or None if there is
+                 no previous report.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f'{self.task_name}.json')
+        previous_path = os.path.join(self.output_dir, f'{self.task_name}.previous.json')
+        if os.path.exists(path):
+            os.replace(path, previous_path)
+        else:
+            previous_path = None
+
+        with open(path, 'w') as f:
+            json.dump({'task': self.task_name, 'statements': self.statements}, f, indent=2, default=str)
+
+        print(f'Profile of {self.task_name}:')
+        for statement in self.statements:
+            print(f"\t{statement['query_hash']}: {statement['wall_time']:.3f} s "
+                  f"(fetch {statement['fetch_time']:.3f} s), {statement['rows']} rows, "
+                  f"{statement['rows_examined']} rows examined, "
+                  f"{statement['status']['Created_tmp_tables']} temp tables "
+                  f"({statement['status']['Created_tmp_disk_tables']} on disk), "
+                  f"{statement['status']['Sort_merge_passes']} sort merge passes")
+        print()
+        return path, previous_path
+
+
+def diff_status(before: dict, after: dict) -> dict:
+    """
+    Computes the change of each status counter.
+
+    :param before: Counters read before.
+    :param after: Counters read after.
+    :return: A dictionary of counter names and changes.
+    """
+    return {name: after[name] - before.get(name, 0) for name in after}
+
+
+def plan_access_types(plan) -> list:
+    """
+    Lists the table access types of an EXPLAIN FORMAT=JSON plan in plan order,
+    e.g. ['Activity:ALL', 'TrackPoint:ref'].
+
+    :param plan: The parsed JSON plan.
+    :return: A list of table:access_type strings.
+    """
+    access_types = []
+    if isinstance(plan, dict):
+        if 'table_name' in plan and 'access_type' in plan:
+            access_types.append(f"{plan['table_name']}:{plan['access_type']}")
+        for value in plan.values():
+            access_types.extend(plan_access_types(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            access_types.extend(plan_access_types(value))
+    return access_types
+
+
+def diff_profiles(old_path: str, new_path: str, time_ratio=1.5) -> list:
+    """
+    Compares two profile reports of the same task and lists the regressions: statements that got slower by more than
+    time_ratio, started using disk temp tables, sort merge passes or full joins, or changed table access types.
+
+    :param old_path: The path of the previous report.
+    :param new_path: The path of the current report.
+    :param time_ratio: The slowdown factor reported as a regression.
+    :return: A list of strings describing the regressions.
+    """
+    with open(old_path) as f:
+        old_statements = {statement['query_hash']: statement for statement in json.load(f)['statements']}
+    with open(new_path) as f:
+        new_statements = json.load(f)['statements']
+
+    regressions = []
+    for new in new_statements:
+        old = old_statements.get(new['query_hash'])
+        if old is None:
+            continue
+
+        name = new['query_hash']
+        if old['wall_time'] > 0 and new['wall_time'] / old['wall_time'] > time_ratio:
+            regressions.append(f"{name}: wall time {old['wall_time']:.3f} s -> {new['wall_time']:.3f} s")
+        for counter in REGRESSION_COUNTERS:
+            if old['status'].get(counter, 0) == 0 and new['status'].get(counter, 0) > 0:
+                regressions.append(f"{name}: {counter} 0 -> {new['status'][counter]}")
+        if 'plan' in old and 'plan' in new:
+            old_access, new_access = plan_access_types(old['plan']), plan_access_types(new['plan'])
+            if old_access != new_access:
+                regressions.append(f"{name}: access types {old_access} -> {new_access}")
+    return regressions
@@ -0,0 +1,274 @@
+import json
+import queue
+import threading
+import contextlib
+import datetime
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from rtree import index
+from Database import Database
+from part2 import Part2
+from helpers import haversine_km
+
+EPOCH = datetime.datetime(1970, 1, 1)
+METERS_PER_DEGREE = 111320.0  # Meters per degree of latitude, used to widen index searches
+TASK_PREVIEW_ROWS = 5  # Result rows of a task printed to the service log
+
+
+def epoch_seconds(date_time: datetime.datetime) -> float:
+    return (date_time - EPOCH).total_seconds()
+
+
+def to_json(result):
+    """
+    Converts a task result to JSON-serializable values.
+
+    :param result: A pd.DataFrame, a dictionary of columns, or a tuple of those for tasks with several results.
+    :return: A list of row dictionaries, or a list of those for tuples.
+    """
+    if result is None:
+        return None
+    if isinstance(result, tuple):
+        return [to_json(part) for part in result]
+    df = result if isinstance(result, pd.DataFrame) else pd.DataFrame(result)
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+
+class QueryService:
+    def __init__(self, pool_size=4, host='127.0.0.1', port=8765, refresh_interval=30.0):
+        """
+        A long-lived query service, which keeps a pool of connected Part2 objects, the activity metadata and a
+        spatio-temporal R-tree of the activities in memory, and answers over HTTP on localhost, so that a question
+        does not pay for connecting, fetching the metadata and building indexes every time.
+
+        The metadata is refreshed incrementally every refresh_interval seconds and on GET /refresh: only activities
+        not seen before are fetched and added to the index. Task results are cached until the data changes. Tasks
+        run on the pool without writing task_outputs, and only a preview of their results is printed.
+
+        Endpoints:
+            GET /tasks/<n>          Result of task n of part 2.
+            GET /nearest?lat=&lon=&time=[&window=30][&radius=50][&k=10]
+                                    Users closest to a position within radius meters and window seconds of time.
+            GET /refresh            Refreshes the metadata and returns the data version.
+            GET /status             Number of cached activities and the data version.
+
+        :param pool_size: Number of database connections, i.e. lookups that can run concurrently.
+        :param host: The address to listen on. Keep it on localhost, there is no authentication.
+        :param port: The port to listen on.
+        :param refresh_interval: Seconds between metadata refreshes. Set to None to only refresh on request.
+        """
+        self.host = host
+        self.port = port
+        self.refresh_interval = refresh_interval
+
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(Part2(database=Database(role='read'), preview_rows=TASK_PREVIEW_ROWS, write_files=False))
+
+        self.activities = {}  # Activity ID: (user_id, transportation_mode, start_date_time, end_date_time)
+        self.spatial_index = index.Index(properties=index.Property(dimension=3))
+        self.index_lock = threading.RLock()
+        self.task_locks = {}  # Task number: lock held while the task runs, so it is not computed twice
+        self.task_locks_lock = threading.Lock()
+        self.task_cache = {}
+        self.version = 0
+
+        self.server = None
+        self.stopped = threading.Event()
+        self.refresh()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a Part2 object from the pool for the duration of a with block.
+        """
+        part2 = self.pool.get()
+        try:
+            yield part2
+        finally:
+            self.pool.put(part2)
+
+    def refresh(self) -> int:
+        """
+        Adds activities inserted since the last refresh to the metadata and the R-tree. The bounding boxes are read
+        from ActivitySignature, and computed from the trackpoints of activities without a signature.
+
+        :return: The data version, which changes whenever new activities are found.
+        """
+        with self.connection() as part2:
+            ids = {row[0] for row in part2.execute_query("SELECT id FROM Activity;")}
+            with self.index_lock:
+                new_ids = sorted(ids - self.activities.keys())
+            if not new_ids:
+                return self.version
+
+            placeholders = ', '.join(['%s'] * len(new_ids))
+            query = f'''SELECT Activity.id, Activity.user_id, Activity.transportation_mode,
+                               Activity.start_date_time, Activity.end_date_time,
+                               ActivitySignature.min_lat, ActivitySignature.min_lon,
+                               ActivitySignature.max_lat, ActivitySignature.max_lon
+                        FROM Activity
+                        LEFT JOIN ActivitySignature ON ActivitySignature.activity_id = Activity.id
+                        WHERE Activity.id IN ({placeholders});'''
+            rows = part2.execute_query(query, tuple(new_ids))
+
+            missing = [row[0] for row in rows if row[5] is None]
+            bounds = {}
+            if missing:
+                placeholders = ', '.join(['%s'] * len(missing))
+                query = f'''SELECT activity_id, MIN(lat), MIN(lon), MAX(lat), MAX(lon)
+                            FROM TrackPoint
+                            WHERE activity_id IN ({placeholders})
+                            GROUP BY activity_id;'''
+                bounds = {row[0]: row[1:] for row in part2.execute_query(query, tuple(missing))}
+
+        with self.index_lock:
+            for activity_id, user_id, mode, start, end, *bbox in rows:
+                if activity_id in self.activities:
+                    continue
+                bbox = bounds.get(activity_id) if bbox[0] is None else bbox
+                self.activities[activity_id] = (user_id, mode, start, end)
+                if bbox:
+                    self.spatial_index.insert(activity_id, (bbox[0], bbox[1], epoch_seconds(start),
+                                                            bbox[2], bbox[3], epoch_seconds(end)))
+            self.version += 1
+            self.task_cache.clear()
+        print(f'Query service: {len(rows)} new activities, data version {self.version}')
+        return self.version
+
+    def task(self, task_num: int):
+        """
+        Runs a task of part 2, or returns its cached result if the data has not changed since it last ran.
+
+        :param task_num: The task number, 1 to 12.
+        :return: The JSON-serializable result, see to_json.
+        """
+        if not 1 <= task_num <= 12:
+            raise ValueError(f"Unknown task: {task_num}")
+        version = self.version
+        if (task_num, version) in self.task_cache:
+            return self.task_cache[(task_num, version)]
+
+        # Different tasks run concurrently on the pool, requests for a task that is running wait for its result
+        with self.task_locks_lock:
+            task_lock = self.task_locks.setdefault(task_num, threading.Lock())
+        with task_lock:
+            if (task_num, version) not in self.task_cache:
+                with self.connection() as part2:
+                    result = getattr(part2, f'task_{task_num}')()
+                self.task_cache[(task_num, version)] = to_json(result)
+            return self.task_cache[(task_num, version)]
+
+    def nearest(self, lat: float, lon: float, date_time: datetime.datetime, window=30, radius=50, k=10) -> list:
+        """
+        Finds the users closest to a position at a point in time. Candidate activities are looked up in the R-tree,
+        and only their trackpoints within the time window are fetched, through the covering index activity_time.
+
+        :param lat: Latitude of the position.
+        :param lon: Longitude of the position.
+        :param date_time: The point in time.
+        :param window: Seconds before and after date_time to include.
+        :param radius: Largest distance in meters to include.
+        :param k: Number of users to return.
+        :return: Up to k dictionaries with user ID, activity ID, distance in meters and date time of the closest
+                 trackpoint of each user, ordered by distance.
+        """
+        lat_margin = radius / METERS_PER_DEGREE
+        lon_margin = lat_margin / max(np.cos(np.radians(lat)), 0.01)
+        timestamp = epoch_seconds(date_time)
+        with self.index_lock:
+            candidates = list(self.spatial_index.intersection((lat - lat_margin, lon - lon_margin, timestamp - window,
+                                                               lat + lat_margin, lon + lon_margin, timestamp + window)))
+        if not candidates:
+            return []
+
+        placeholders = ', '.join(['%s'] * len(candidates))
+        query = f'''SELECT activity_id, date_time, lat, lon
+                    FROM TrackPoint FORCE INDEX (activity_time)
+                    WHERE activity_id IN ({placeholders}) AND date_time BETWEEN %s AND %s;'''
+        delta = datetime.timedelta(seconds=window)
+        with self.connection() as part2:
+            rows = part2.execute_query(query, (*candidates, date_time - delta, date_time + delta))
+        if not rows:
+            return []
+
+        df = pd.DataFrame(rows, columns=['activity_id', 'date_time', 'lat', 'lon'])
+        df['distance'] = haversine_km(lat, lon, df['lat'].to_numpy(), df['lon'].to_numpy()) * 1000
+        df = df[df['distance'] <= radius].copy()
+        df['user_id'] = [self.activities[activity_id][0] for activity_id in df['activity_id']]
+
+        closest = df.sort_values('distance').drop_duplicates('user_id').head(k)
+        return [{'user_id': row.user_id, 'activity_id': int(row.activity_id), 'distance': round(row.distance, 1),
+                 'date_time': row.date_time.isoformat()} for row in closest.itertuples()]
+
+    def refresh_periodically(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"ERROR: Failed to refresh the query service: {e}")
+
+    def serve(self):
+        """
+        Serves requests until interrupted.
+        """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {name: values[0] for name, values in parse_qs(url.query).items()}
+                try:
+                    if url.path.startswith('/tasks/'):
+                        body = service.task(int(url.path[len('/tasks/'):]))
+                    elif url.path == '/nearest':
+                        body = service.nearest(float(params['lat']), float(params['lon']),
+                                               datetime.datetime.fromisoformat(params['time']),
+                                               float(params.get('window', 30)), float(params.get('radius', 50)),
+                                               int(params.get('k', 10)))
+                    elif url.path == '/refresh':
+                        body = {'version': service.refresh()}
+                    elif url.path == '/status':
+                        body = {'activities': len(service.activities), 'version': service.version}
+                    else:
+                        self.respond(404, {'error': f'Unknown path: {url.path}'})
+                        return
+                except (KeyError, ValueError) as e:
+                    self.respond(400, {'error': f'Bad request: {e}'})
+                    return
+                except Exception as e:  # e.g. a database error, or a query returning None after one
+                    print(f"ERROR: Failed to serve {self.path}: {e}")
+                    self.respond(500, {'error': f'Internal error: {e}'})
+                    return
+                self.respond(200, body)
+
+            def respond(self, status: int, body):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.refresh_interval:
+            threading.Thread(target=self.refresh_periodically, daemon=True).start()
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        print(f'Query service listening on http://{self.host}:{self.port}')
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        if self.server:
+            self.server.server_close()
+        while not self.pool.empty():
+            self.pool.get().database.close_connection()
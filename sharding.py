@@ -0,0 +1,380 @@
+import time
+import zlib
+import heapq
+from bisect import bisect_right
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pandas as pd
+from Database import Database, hosts_from_env
+from part1 import Part1
+from data_processing import process_users, subset_settings
+from part2 import Part2, group_trackpoints, find_close_users
+from helpers import time_elapsed_str
+from approximation import sampling_condition, decimation_condition
+
+
+def shard_for(user_id: str, num_shards: int) -> int:
+    """
+    Determines which shard stores a user, with all of its activities and trackpoints.
+
+    :param user_id: The ID of the user.
+    :param num_shards: The number of shards.
+    :return: The index of the shard.
+    """
+    return zlib.crc32(user_id.encode()) % num_shards
+
+
+def shard_hosts_from_env() -> list:
+    """
+    Reads the shard servers from the DB_SHARDS environment variable, a comma separated list of host:port entries,
+    e.g. "localhost:3306,localhost:3307".
+
+    :return: A list of (host, port) tuples.
+    """
+    return hosts_from_env('DB_SHARDS')
+
+
+def run_query(database: Database, query: str, params=None) -> list:
+    """
+    Executes a query on one shard.
+
+    :param database: The Database object of the shard.
+    :param query: SQL query to be executed.
+    :param params: Parameters for query.
+    :return: The rows of the result.
+    """
+    database.cursor.execute(query, params)
+    return database.cursor.fetchall()
+
+
+class ShardedDatabase:
+    def __init__(self, shard_hosts=None):
+        """
+        Connects to every shard.
+
+        :param shard_hosts: A list of (host, port) tuples. Omit to read them from DB_SHARDS.
+        """
+        self.shard_hosts = shard_hosts or shard_hosts_from_env()
+        if not self.shard_hosts:
+            raise ValueError("No shards given. Pass shard_hosts or set DB_SHARDS")
+
+        self.databases = [Database(host=host, port=port) for host, port in self.shard_hosts]
+        self.cursor = None  # Queries go through the shards, see scatter
+
+    def scatter(self, function, *args) -> list:
+        """
+        Calls a function for each shard in parallel, one thread per shard.
+
+        :param function: A function taking the Database object of a shard as first argument.
+        :param args: Additional arguments to the function.
+        :return: A list of the return values, in shard order.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.databases)) as executor:
+            return list(executor.map(lambda database: function(database, *args), self.databases))
+
+    def close_connection(self):
+        """
+        Closes the connection to every shard.
+        """
+        for database in self.databases:
+            database.close_connection()
+
+
+def upload_shard(host: str, port: int, subset: dict, storage_mode: str, data_path: str):
+    """
+    Uploads the users of one shard. Runs in a separate process, with its own connection.
+
+    :param host: The host of the shard.
+    :param port: The port of the shard.
+    :param subset: The filter of the shard, selecting the IDs of the users stored in it, see subset_settings.
+    :param storage_mode: How trackpoints are stored, see Part1.insert_data.
+    :param data_path: The path to the user directories or the archive of the dataset.
+    """
+    part1 = Part1(database=Database(host=host, port=port))
+    part1.upload_data(storage_mode=storage_mode, subset=subset, data_path=data_path)
+
+
+class ShardedPart1:
+    def __init__(self, shard_hosts=None):
+        """
+        Inits part 1 on several shards. Users are partitioned across the shards by shard_for.
+
+        :param shard_hosts: A list of (host, port) tuples. Omit to read them from DB_SHARDS.
+        """
+        self.shard_hosts = shard_hosts or shard_hosts_from_env()
+        if not self.shard_hosts:
+            raise ValueError("No shards given. Pass shard_hosts or set DB_SHARDS")
+
+    def upload_data(self, storage_mode='rows', data_path='./dataset/dataset/Data', subset=None):
+        """
+        Uploads the data to every shard in parallel, one process per shard.
+        Duplicate activities are only detected within a shard, see Part1.insert_data.
+
+        :param storage_mode: How trackpoints are stored, see Part1.insert_data.
+        :param data_path: The path to the user directories or the archive of the dataset.
+        :param subset: The filter of a subset ingest, see subset_settings. The users are selected before they are
+                       partitioned, and the activity filters are applied on every shard. Omit to upload all.
+        """
+        start_time = time.time()
+        subset = subset or subset_settings()
+        num_shards = len(self.shard_hosts)
+        shard_users = [[] for _ in range(num_shards)]
+        for user_row in process_users(data_path, labeled_ids=[], subset=subset):
+            shard_users[shard_for(user_row['id'], num_shards)].append(user_row['id'])
+
+        with ProcessPoolExecutor(max_workers=num_shards) as executor:
+            futures = [executor.submit(upload_shard, host, port, {**subset, 'user_ids': user_ids}, storage_mode,
+                                       data_path)
+                       for (host, port), user_ids in zip(self.shard_hosts, shard_users)]
+            for future in futures:
+                future.result()
+
+        print(f'\nSharded insertion complete - Total time: {time_elapsed_str(start_time)}')
+
+
+def time_close_activity_pairs(activities: list) -> list:
+    """
+    Finds pairs of activities of different users that overlap in time, allowing 30 seconds between them.
+    Equivalent to the self join in Part2.get_users_in_proximity, but computed client-side so that activities stored
+    on different shards are paired too.
+
+    :param activities: A list of (activity_id, user_id, start_date_time, end_date_time) tuples.
+    :return: A list of (activity_id_1, activity_id_2, user_id_1, user_id_2) tuples with activity_id_1 < activity_id_2.
+    """
+    tolerance = timedelta(seconds=30)
+    activities = sorted(activities, key=lambda activity: activity[2])
+    starts = [activity[2] for activity in activities]
+
+    pairs = []
+    for i, (activity_id, user_id, _, end_date_time) in enumerate(activities):
+        # Every later starting activity that starts before this one ends overlaps with it
+        for other_id, other_user_id, _, _ in activities[i + 1:bisect_right(starts, end_date_time + tolerance)]:
+            if user_id != other_user_id:
+                if activity_id < other_id:
+                    pairs.append((activity_id, other_id, user_id, other_user_id))
+                else:
+                    pairs.append((other_id, activity_id, other_user_id, user_id))
+    return pairs
+
+
+class ShardedPart2(Part2):
+    def __init__(self, shard_hosts=None, sink_format=None, preview_rows=None, write_files=True, profile=False):
+        """
+        Inits part 2 on several shards. Every task runs on each shard in parallel (scatter), and the partial results
+        are merged client-side (gather). Since a user is stored on exactly one shard, per-user aggregates are exact on
+        each shard, and top-k results are merged from the top-k of each shard.
+
+        :param shard_hosts: A list of (host, port) tuples. Omit to read them from DB_SHARDS.
+        :param sink_format: Format of the task output files, see Part2.
+        :param preview_rows: Number of result rows to print per task, see Part2.
+        :param write_files: Set to False to only print the task results, see Part2.
+        :param profile: Profiling is not supported on shards, since the queries of a task run on several connections.
+                        Profile a shard on its own with Part2(database=Database(host, port), profile=True) instead.
+        """
+        if profile:
+            raise ValueError("Profiling is not supported on shards. Profile each shard with Part2 instead")
+        super().__init__(sink_format=sink_format, preview_rows=preview_rows, database=ShardedDatabase(shard_hosts),
+                         write_files=write_files)
+        self.shards = [Part2(sink_format=sink_format, preview_rows=preview_rows, database=database)
+                       for database in self.database.databases]
+
+    def scatter(self, method_name: str, *args) -> list:
+        """
+        Calls a Part2 method on every shard in parallel.
+
+        :param method_name: The name of the method.
+        :param args: Arguments to the method.
+        :return: A list of the return values, in shard order.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            return list(executor.map(lambda shard: getattr(shard, method_name)(*args), self.shards))
+
+    def gather_rows(self, method_name: str, *args) -> list:
+        """
+        Calls a Part2 method returning rows on every shard, and concatenates the rows.
+        """
+        return [row for rows in self.scatter(method_name, *args) for row in rows or []]
+
+    def execute_query(self, query, params=None):
+        """
+        Executes a query on every shard and concatenates the rows. Only row-level queries can be merged this way,
+        aggregates have to be merged by the overriding methods below.
+        """
+        return self.gather_rows('execute_query', query, params)
+
+    def stream_query(self, query, params=None, batch_size=5000):
+        """
+        Executes a query on one shard after the other and yields the batches of rows, see execute_query.
+        """
+        for shard in self.shards:
+            yield from shard.stream_query(query, params, batch_size)
+
+    # TASK 1
+    def get_user_count(self):
+        return sum(self.scatter('get_user_count'))
+
+    def get_activity_count(self):
+        return sum(self.scatter('get_activity_count'))
+
+    def get_tp_count(self):
+        return sum(self.scatter('get_tp_count'))
+
+    # TASK 2
+    def get_avg_tp(self):
+        return self.get_tp_count() / self.get_user_count()
+
+    def get_max_tp(self):
+        return max(value for value in self.scatter('get_max_tp') if value is not None)
+
+    def get_min_tp(self):
+        return min(value for value in self.scatter('get_min_tp') if value is not None)
+
+    # TASK 3
+    def get_top_15_activities(self):
+        return heapq.nlargest(15, self.gather_rows('get_top_15_activities'), key=lambda row: row[1])
+
+    # TASK 4
+    def get_transportation_by_bus(self):
+        return sorted(set(self.gather_rows('get_transportation_by_bus')))
+
+    # TASK 5
+    def get_distinct_transportation_modes(self):
+        return heapq.nlargest(10, self.gather_rows('get_distinct_transportation_modes'), key=lambda row: row[1])
+
+    # TASK 6
+    def get_duplicate_activities(self):
+        return self.gather_rows('get_duplicate_activities')
+
+    # TASK 7
+    def get_count_multiple_day_activities(self):
+        return (sum(row[0] for row in self.scatter('get_count_multiple_day_activities')),)
+
+    def get_list_multiple_day_activities(self, stream=False):
+        rows = sorted(self.gather_rows('get_list_multiple_day_activities'), key=lambda row: (row[0], -row[3]))
+        return iter([rows]) if stream else rows
+
+    # TASK 8
+    def get_users_in_proximity(self):
+        """
+        Determines the number of users who have been in proximity to another user, see Part2.get_users_in_proximity.
+        Activities close in time are paired client-side across all shards, and the trackpoints of each paired
+        activity are fetched from the shard that stores it. In approximate runs, the activities are sampled and the
+        trackpoints decimated on each shard.
+
+        :return: int
+            The number of unique users who have been in proximity to another user.
+        """
+        start_time = time.time()
+
+        # 1. FILTER BY TIME
+        query_activities = "SELECT id, user_id, start_date_time, end_date_time FROM Activity"
+        params_activities = []
+        if self.approximation:
+            condition, params_activities = sampling_condition(self.approximation)
+            query_activities += f" WHERE {condition}"
+        shard_activities = self.database.scatter(lambda database: run_query(database, query_activities,
+                                                                            tuple(params_activities)))
+        time_close_activities = time_close_activity_pairs([row for rows in shard_activities for row in rows])
+
+        # 2. FETCH ALL TRACKPOINTS, EACH FROM ITS OWN SHARD
+        unique_activity_ids = set()
+        for activity in time_close_activities:
+            unique_activity_ids.add(activity[0])
+            unique_activity_ids.add(activity[1])
+
+        def fetch_trackpoints(database, activities):
+            activity_ids = [row[0] for row in activities if row[0] in unique_activity_ids]
+            if not activity_ids:
+                return []
+            placeholders = ', '.join(['%s'] * len(activity_ids))
+            query = f"SELECT activity_id, lat, lon, altitude FROM TrackPoint WHERE activity_id IN ({placeholders})"
+            params = list(activity_ids)
+            if self.approximation and self.approximation['decimation'] > 1:
+                condition, decimate_params = decimation_condition(self.approximation)
+                query += f" AND {condition}"
+                params.extend(decimate_params)
+            return run_query(database, query, tuple(params))
+
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            shard_trackpoints = list(executor.map(fetch_trackpoints, self.database.databases, shard_activities))
+        all_trackpoints = [row for rows in shard_trackpoints for row in rows]
+
+        # 3. SPATIAL FILTERING USING R-TREE AND 4. FIND USERS IN PROXIMITY
+        close_users_set = find_close_users(time_close_activities, group_trackpoints(all_trackpoints))
+
+        print(f'\rFinished. Time elapsed: {time_elapsed_str(start_time)}')
+        return len(close_users_set)
+
+    # TASK 9
+    def get_top_altitude_gains(self):
+        return heapq.nlargest(15, self.gather_rows('get_top_altitude_gains'), key=lambda row: row[1])
+
+    def get_altitude_gain_contributions(self, approximation: dict):
+        return pd.concat(self.scatter('get_altitude_gain_contributions', approximation), ignore_index=True)
+
+    # TASK 10
+    def get_distance_contributions(self, approximation: dict):
+        return pd.concat(self.scatter('get_distance_contributions', approximation), ignore_index=True)
+
+    def get_longest_distance_per_transportation(self):
+        max_distances = {}
+        for user, mode, distance in self.gather_rows('get_longest_distance_per_transportation'):
+            if mode not in max_distances or max_distances[mode][1] < distance:
+                max_distances[mode] = (user, distance)
+        return [[user, mode, distance] for mode, (user, distance) in max_distances.items()]
+
+    # TASK 11
+    def get_invalid_activities(self, precomputed=False):
+        return sorted(self.gather_rows('get_invalid_activities', precomputed))
+
+    # TASK 12
+    def get_most_used_transportations(self):
+        return sorted(self.gather_rows('get_most_used_transportations'))
+
+    # DENSITY CUBE
+    def get_trackpoint_density(self, resolution=0.01, lat_range=None, lon_range=None, time_range=None,
+                               transportation_mode=None, user_id=None, group_by=('cell_lat', 'cell_lon')):
+        results = self.scatter('get_trackpoint_density', resolution, lat_range, lon_range, time_range,
+                               transportation_mode, user_id, group_by)
+        result = pd.concat(results, ignore_index=True)
+        if not group_by:
+            return pd.DataFrame({'point_count': [result['point_count'].sum()]})
+        return result.groupby(list(group_by), as_index=False)['point_count'].sum()
+
+    # SIMILARITY SEARCH
+    def get_activity_signature(self, activity_id: int):
+        return next((signature for signature in self.scatter('get_activity_signature', activity_id) if signature),
+                    None)
+
+    def get_similar_signatures(self, signature, activity_id: int, k=10, max_distance=2000, cell_size=0.01,
+                               batch_size=256):
+        results = self.scatter('get_similar_signatures', signature, activity_id, k, max_distance, cell_size,
+                               batch_size)
+        result = pd.concat(results, ignore_index=True)
+        return result.sort_values('Distance (meters)', kind='stable', ignore_index=True).head(k)
+
+    # TRAJECTORY WINDOWS
+    def iter_trackpoints(self, user_id=None, activity_ids=None, time_range=None, page_size=10000):
+        """
+        Iterates over trackpoints page by page, see Part2.iter_trackpoints. With user_id, only the shard storing the
+        user is queried. Otherwise the shards are iterated one after the other, so pages are ordered by activity and
+        time within each shard only.
+        """
+        if user_id is not None:
+            shards = [self.shards[shard_for(user_id, len(self.shards))]]
+        else:
+            shards = self.shards
+        for shard in shards:
+            yield from shard.iter_trackpoints(user_id, activity_ids, time_range, page_size)
+
+    # STAY POINTS
+    def get_stay_points(self, user_id=None, min_duration=None):
+        result = pd.concat(self.scatter('get_stay_points', user_id, min_duration), ignore_index=True)
+        return result.sort_values(['User ID', 'Arrival'], ignore_index=True)
+
+    # TRACK BLOBS
+    def get_trajectories(self, activity_ids: list) -> dict:
+        trajectories = {}
+        for shard_trajectories in self.scatter('get_trajectories', activity_ids):
+            trajectories.update(shard_trajectories)
+        return trajectories
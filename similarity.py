@@ -0,0 +1,102 @@
+import numpy as np
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def resample_polyline(lat: np.ndarray, lon: np.ndarray, num_points: int) -> np.ndarray:
+    """
+    Resamples a trajectory to a fixed number of points, evenly spaced along its length.
+
+    :param lat: Latitudes of the trajectory in degrees.
+    :param lon: Longitudes of the trajectory in degrees.
+    :param num_points: The number of points in the resampled polyline.
+    :return: A (num_points, 2) float32 array of (lat, lon) pairs.
+    """
+    points = np.column_stack((lat, lon)).astype(np.float64)
+    if len(points) == 1:
+        return np.repeat(points, num_points, axis=0).astype(np.float32)
+
+    segment_lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    arc_length = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+    if arc_length[-1] == 0:
+        return np.repeat(points[:1], num_points, axis=0).astype(np.float32)
+
+    samples = np.linspace(0, arc_length[-1], num_points)
+    return np.column_stack((np.interp(samples, arc_length, points[:, 0]),
+                            np.interp(samples, arc_length, points[:, 1]))).astype(np.float32)
+
+
+def encode_polyline(polyline: np.ndarray) -> bytes:
+    """
+    Encodes a resampled polyline for storage in a BLOB column.
+
+    :param polyline: A (num_points, 2) array of (lat, lon) pairs.
+    :return: The polyline as little-endian float32 bytes.
+    """
+    return polyline.astype('<f4').tobytes()
+
+
+def decode_polylines(blobs: list) -> np.ndarray:
+    """
+    Decodes stored polylines of equal length into one array.
+
+    :param blobs: A list of polylines encoded by encode_polyline.
+    :return: A (num_polylines, num_points, 2) float64 array of (lat, lon) pairs.
+    """
+    return np.frombuffer(b''.join(blobs), dtype='<f4').reshape(len(blobs), -1, 2).astype(np.float64)
+
+
+def point_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Computes the distance in meters between (lat, lon) points with an equirectangular approximation, which is accurate
+    for the short distances compared here. The arrays are broadcast against each other.
+
+    :param a: An array of (lat, lon) pairs in degrees, with the pairs along the last axis.
+    :param b: An array of (lat, lon) pairs in degrees, with the pairs along the last axis.
+    :return: An array of distances in meters.
+    """
+    a, b = np.radians(a), np.radians(b)
+    x = (b[..., 1] - a[..., 1]) * np.cos((a[..., 0] + b[..., 0]) / 2)
+    y = b[..., 0] - a[..., 0]
+    return EARTH_RADIUS_METERS * np.sqrt(x ** 2 + y ** 2)
+
+
+def endpoint_lower_bounds(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """
+    Computes a lower bound of the discrete Fréchet distance between a query polyline and each candidate. Every
+    coupling has to match the first points and the last points with each other, so the distance is at least the
+    largest of those two distances.
+
+    :param query: A (num_points, 2) array of (lat, lon) pairs.
+    :param candidates: A (num_candidates, num_points, 2) array of (lat, lon) pairs.
+    :return: A (num_candidates,) array of lower bounds in meters.
+    """
+    return np.maximum(point_distances(query[0], candidates[:, 0]), point_distances(query[-1], candidates[:, -1]))
+
+
+def discrete_frechet(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """
+    Computes the discrete Fréchet distance between a query polyline and a batch of candidate polylines. The dynamic
+    programming table is filled for all candidates at once, so the Python loop only runs over the table cells.
+
+    :param query: A (num_points, 2) array of (lat, lon) pairs.
+    :param candidates: A (num_candidates, num_points, 2) array of (lat, lon) pairs.
+    :return: A (num_candidates,) array of distances in meters.
+    """
+    # distances[c, i, j] is the distance between query point i and point j of candidate c
+    distances = point_distances(query[None, :, None, :], candidates[:, None, :, :])
+    num_query, num_candidate = distances.shape[1], distances.shape[2]
+
+    coupling = np.empty_like(distances)
+    coupling[:, 0, 0] = distances[:, 0, 0]
+    for i in range(1, num_query):
+        coupling[:, i, 0] = np.maximum(coupling[:, i - 1, 0], distances[:, i, 0])
+    for j in range(1, num_candidate):
+        coupling[:, 0, j] = np.maximum(coupling[:, 0, j - 1], distances[:, 0, j])
+
+    for i in range(1, num_query):
+        for j in range(1, num_candidate):
+            previous = np.minimum(np.minimum(coupling[:, i - 1, j], coupling[:, i - 1, j - 1]), coupling[:, i, j - 1])
+            coupling[:, i, j] = np.maximum(previous, distances[:, i, j])
+
+    return coupling[:, -1, -1]
@@ -0,0 +1,130 @@
+import csv
+import json
+import os
+
+
+class CsvSink:
+    """
+    Writes result rows incrementally to a CSV file.
+    """
+
+    extension = 'csv'
+
+    def __init__(self, path: str, columns: list):
+        """
+        Opens the file and writes the header row.
+
+        :param path: The path of the file to write to.
+        :param columns: The column names of the result table.
+        """
+        self.columns = columns
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write_rows(self, rows: list):
+        """
+        Appends a batch of rows to the file.
+
+        :param rows: A list of tuples, each representing a row.
+        """
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesSink:
+    """
+    Writes result rows incrementally to a JSON lines file, one object per row.
+    """
+
+    extension = 'jsonl'
+
+    def __init__(self, path: str, columns: list):
+        """
+        Opens the file.
+
+        :param path: The path of the file to write to.
+        :param columns: The column names of the result table.
+        """
+        self.columns = columns
+        self.file = open(path, 'w')
+
+    def write_rows(self, rows: list):
+        """
+        Appends a batch of rows to the file.
+
+        :param rows: A list of tuples, each representing a row.
+        """
+        for row in rows:
+            self.file.write(json.dumps(dict(zip(self.columns, row)), default=str) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """
+    Writes result rows incrementally to a Parquet file, one row group per batch. Requires pyarrow.
+    """
+
+    extension = 'parquet'
+
+    def __init__(self, path: str, columns: list):
+        """
+        Prepares the writer. The file is created when the first batch arrives, since the schema is inferred from it.
+
+        :param path: The path of the file to write to.
+        :param columns: The column names of the result table.
+        """
+        import pyarrow  # Optional dependency, only needed for this sink
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.columns = columns
+        self.writer = None
+
+    def write_rows(self, rows: list):
+        """
+        Appends a batch of rows to the file as a new row group.
+
+        :param rows: A list of tuples, each representing a row.
+        """
+        if not rows:
+            return
+        import pyarrow.parquet
+
+        table = self.pyarrow.Table.from_pylist([dict(zip(self.columns, row)) for row in rows])
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+SINKS = {
+    'csv': CsvSink,
+    'jsonl': JsonLinesSink,
+    'parquet': ParquetSink
+}
+
+
+def open_sink(sink_format: str, filename: str, columns: list, directory='task_outputs'):
+    """
+    Opens an output sink for a result table.
+
+    :param sink_format: The output format, one of 'csv', 'jsonl' or 'parquet'.
+    :param filename: The name of the file to write to, without extension.
+    :param columns: The column names of the result table.
+    :param directory: The directory to write the file to.
+    :return: A sink object with write_rows(rows) and close() methods.
+    """
+    if sink_format not in SINKS:
+        raise ValueError(f"Unknown sink format: {sink_format}. Use one of {list(SINKS.keys())}")
+
+    sink_class = SINKS[sink_format]
+    os.makedirs(directory, exist_ok=True)
+    return sink_class(os.path.join(directory, f'{filename}.{sink_class.extension}'), list(columns))
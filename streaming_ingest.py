@@ -0,0 +1,227 @@
+import os
+import json
+import time
+from part1 import Part1
+from data_processing import process_activity, fingerprint_activity
+from helpers import time_elapsed_str
+
+
+class StreamingIngest:
+    def __init__(self, part1: Part1, data_path='./dataset/dataset/Data', index_path='./ingest_index.json',
+                 poll_interval=2.0, max_batch_activities=50, max_latency=5.0, deduplicate=True,
+                 density_resolutions=(0.1, 0.01), storage_mode='rows'):
+        """
+        Watches the user Trajectory directories for new PLT files and inserts them in micro-batches, as a long-running
+        alternative to Part1.upload_data. The directories are polled, and the mtime and size of every file seen is
+        kept in an index that is saved to index_path, so a restarted watcher does not insert a file twice. Files are
+        only added to the index once their micro-batch has committed, so a failed batch is retried on a later poll.
+
+        A file is only parsed once its mtime and size are unchanged between two polls and it ends with a newline,
+        so files that are still being written are left for a later poll.
+
+        :param part1: The Part1 object to insert with. Its tables must already exist.
+        :param data_path: The path to the user directories.
+        :param index_path: The path of the index of seen files.
+        :param poll_interval: Seconds between polls of the directories.
+        :param max_batch_activities: Number of buffered activities that triggers a commit.
+        :param max_latency: Seconds an activity may stay buffered before it is committed.
+        :param deduplicate: A flag to skip activities with duplicate trackpoint content, see Part1.insert_data.
+                            Duplicates are detected among the activities inserted by this watcher.
+        :param density_resolutions: The grid resolutions in degrees of the DensityCube, see Part1.insert_data.
+        :param storage_mode: How trackpoints are stored, see Part1.insert_data.
+        """
+        self.part1 = part1
+        self.data_path = data_path
+        self.index_path = index_path
+        self.poll_interval = poll_interval
+        self.max_batch_activities = max_batch_activities
+        self.max_latency = max_latency
+        self.deduplicate = deduplicate
+        self.density_resolutions = density_resolutions
+        self.storage_mode = storage_mode
+
+        self.buffers = part1.new_buffers()
+        self.oldest_buffered = None
+        self.fingerprints = set()
+        self.batch_fingerprints = set()  # Fingerprints of the buffered activities, forgotten if their batch fails
+        self.batch_files = []  # (path, stat) of the files parsed since the last commit
+        self.pending = {}  # Files seen in the last poll, not yet stable
+        self.num_inserted = 0  # Activities committed by this watcher
+
+        self.index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+        self.part1.database.cursor.execute("SELECT id FROM User;")
+        self.known_users = {row[0] for row in self.part1.database.cursor.fetchall()}
+
+    def mark_existing(self):
+        """
+        Adds every file currently in the directories to the index without inserting it, for a watcher started after
+        a full upload with Part1.upload_data.
+        """
+        for path, stat in self.scan():
+            self.index[path] = stat
+        self.save_index()
+
+    def scan(self):
+        """
+        Lists the PLT files in the user Trajectory directories.
+
+        :return: Generator of (path, [mtime_ns, size]) tuples.
+        """
+        with os.scandir(self.data_path) as users:
+            for user in users:
+                trajectory_path = os.path.join(user.path, 'Trajectory')
+                if not user.is_dir() or not os.path.isdir(trajectory_path):
+                    continue
+                with os.scandir(trajectory_path) as activities:
+                    for activity in activities:
+                        if activity.is_file() and activity.name.endswith('.plt'):
+                            stat = activity.stat()
+                            yield activity.path, [stat.st_mtime_ns, stat.st_size]
+
+    def ready_files(self) -> list:
+        """
+        Polls the directories for new or changed files, and returns the ones that are stable since the last poll.
+
+        :return: A list of (path, [mtime_ns, size]) tuples.
+        """
+        ready = []
+        current = {}
+        for path, stat in self.scan():
+            if self.index.get(path) == stat:
+                continue
+            if path in self.index:
+                print(f'\nWARNING: {path} changed after it was inserted, ignoring the change')
+                self.index[path] = stat
+                continue
+
+            current[path] = stat
+            if self.pending.get(path) == stat and stat[1] > 0 and self.ends_with_newline(path):
+                ready.append((path, stat))
+                del current[path]
+        self.pending = current
+        return ready
+
+    @staticmethod
+    def ends_with_newline(path: str) -> bool:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def user_row(self, user_id: str) -> dict:
+        """
+        Creates the user row of a user directory, inserting the user if it is new.
+
+        :param user_id: The ID of the user.
+        :return: A dictionary containing user data, see process_users.
+        """
+        user_path = os.path.join(self.data_path, user_id)
+        user_row = {
+            "id": user_id,
+            "has_labels": os.path.exists(os.path.join(user_path, 'labels.txt')),
+            "meta": {"path": user_path}
+        }
+        if user_id not in self.known_users:
+            self.part1.database.insert_batch(batch=[{"id": user_id, "has_labels": user_row['has_labels']}],
+                                             table_name='User')
+            self.known_users.add(user_id)
+        return user_row
+
+    def ingest_file(self, path: str) -> bool:
+        """
+        Parses a PLT file with process_activity and buffers the activity.
+
+        :param path: The path of the PLT file.
+        :return: True if the activity was buffered.
+        """
+        user_id = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        user_row = self.user_row(user_id)
+        activity_row = {
+            "id": int(os.path.basename(path)[:-4] + user_id),
+            "user_id": user_id,
+            "transportation_mode": None,
+            "meta": {"path": path}
+        }
+        try:
+            activity, trackpoints_df = process_activity(user_row, activity_row=activity_row)
+        except Exception as e:
+            print(f"\nERROR: Failed to parse {path}: {e}")
+            return False
+        if not activity:  # means number of trackpoints > 2500
+            return False
+
+        if self.deduplicate:
+            fingerprint = fingerprint_activity(activity, trackpoints_df)
+            if fingerprint in self.fingerprints:
+                return False
+            self.fingerprints.add(fingerprint)
+            self.batch_fingerprints.add(fingerprint)
+
+        self.part1.buffer_activity(activity, trackpoints_df, self.buffers, self.density_resolutions,
+                                   self.storage_mode)
+        if self.oldest_buffered is None:
+            self.oldest_buffered = time.time()
+        return True
+
+    def flush(self, force=False):
+        """
+        Commits the buffered activities when the batch is full or the oldest activity has waited max_latency, and
+        adds the files of the batch to the index once it has committed.
+
+        :param force: A flag to commit regardless of the batch size and latency.
+        """
+        if self.buffers['activity']:
+            full = len(self.buffers['activity']) >= self.max_batch_activities
+            late = time.time() - self.oldest_buffered >= self.max_latency
+            if not (force or full or late):
+                return
+            num_activities = len(self.buffers['activity'])
+            committed = self.part1.push_buffers(self.buffers)
+            self.oldest_buffered = None
+            if committed:
+                self.num_inserted += num_activities
+            else:
+                print(f'\nWARNING: Failed to commit {len(self.batch_files)} files, retrying them on a later poll')
+                self.fingerprints -= self.batch_fingerprints
+                self.batch_fingerprints.clear()
+                self.batch_files.clear()
+                return
+
+        if not (force or self.batch_files):
+            return
+        # Also records files that were skipped without buffering an activity
+        for path, stat in self.batch_files:
+            self.index[path] = stat
+        self.batch_fingerprints.clear()
+        self.batch_files.clear()
+        self.save_index()
+
+    def save_index(self):
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f)
+
+    def run(self, max_polls=None):
+        """
+        Polls and inserts until interrupted, or for max_polls polls.
+
+        :param max_polls: Number of polls before returning. Omit to run until interrupted.
+        """
+        start_time = time.time()
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                for path, stat in self.ready_files():
+                    self.ingest_file(path)
+                    self.batch_files.append((path, stat))
+                    # Commit whenever the batch fills up, also in the middle of a large poll
+                    self.flush()
+                self.flush()
+                polls += 1
+                print(f'\rStreaming ingest: {self.num_inserted} activities inserted, '
+                      f'Time elapsed: {time_elapsed_str(start_time)}', end='')
+                time.sleep(self.poll_interval)
+        finally:
+            self.flush(force=True)